@@ -0,0 +1,112 @@
+import cv2
+import numpy as np
+
+from utils import conditional_save, get_conditional_path, get_ocr_data, get_text
+
+ATLAS_WIDTH = 2500  # width of the canvases, unless a region is wider, in pixels
+ATLAS_HEIGHT = 3500 # height after which a new canvas is started, in pixels
+ATLAS_GAP = 50      # white space around each region, wide enough for tesseract to keep them in separate blocks
+
+def pack(sizes: 'list[tuple[int, int]]', width: int = ATLAS_WIDTH, height: int = ATLAS_HEIGHT, gap: int = ATLAS_GAP) -> 'tuple[list[tuple[int, int, int]], list[tuple[int, int]]]':
+    '''Lay rectangles out on as few canvases as possible, in shelves.
+
+    The rectangles are placed from the tallest to the shortest, left to right
+    on the current shelf, starting a new shelf below it when the canvas is
+    full and a new canvas when the shelf would pass the height.
+
+    Args:
+        sizes (list[tuple[int, int]]): width and height of each rectangle
+        width (int): width of the canvases, widened to fit the widest rectangle. default=ATLAS_WIDTH
+        height (int): maximum height of the canvases, only exceeded by rectangles taller than it. default=ATLAS_HEIGHT
+        gap (int): space between the rectangles and around the canvas border. default=ATLAS_GAP
+
+    Returns:
+        tuple[list[tuple[int, int, int]], list[tuple[int, int]]]: canvas, x and y of
+        each rectangle, and the width and height of each canvas
+    '''
+    width = max([width] + [w + 2 * gap for w, _ in sizes])
+    placements = [None] * len(sizes)
+    canvases = []
+    x, y, shelf = gap, gap, 0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[i]
+        if x + w + gap > width: # next shelf
+            x, y, shelf = gap, y + shelf + gap, 0
+        if len(canvases) == 0 or (y + h + gap > height and y > gap): # next canvas
+            canvases.append([0, 0])
+            x, y, shelf = gap, gap, 0
+        placements[i] = (len(canvases) - 1, x, y)
+        canvases[-1] = [max(canvases[-1][0], x + w + gap), max(canvases[-1][1], y + h + gap)]
+        x, shelf = x + w + gap, max(shelf, h)
+    return placements, [tuple(c) for c in canvases]
+
+
+def ocr_regions(image, coords: 'list[tuple[int, int, int, int]]', temp_folder: str = None, width: int = ATLAS_WIDTH, height: int = ATLAS_HEIGHT,
+                gap: int = ATLAS_GAP, engine=None, min_confidence: float = 40, verbose: bool = False) -> 'tuple[str, float, pd.DataFrame]':
+    '''Read the regions of a page with one tesseract call per canvas instead of one per region.
+
+    The regions are packed onto a few white canvases, see pack, and each word
+    tesseract finds is mapped back to the region its box center falls in. The
+    text of each region is joined as get_text does for a page.
+
+    Args:
+        image (cv2 image): inverse binary page the regions are in, e.g. returned by segment
+        coords (list[tuple[int, int, int, int]]): bounding box (x, y, w, h) of each region
+        temp_folder (str): folder to save the canvases to, does not save if equals None. default=None
+        width (int): width of the canvases. default=ATLAS_WIDTH
+        height (int): maximum height of the canvases. default=ATLAS_HEIGHT
+        gap (int): white space around each region. default=ATLAS_GAP
+        engine (tesserocr.PyTessBaseAPI): loaded tesseract instance, see get_ocr_data. default=None
+        min_confidence (float): minimum mean confidence of the paragraphs kept. default=40
+        verbose (bool): write extra information to console?
+
+    Returns:
+        tuple(str, float, pd.DataFrame): text of the regions in the given order,
+        mean confidence score and the words that were kept, with their boxes in
+        page coordinates and the index of their region
+    '''
+    import pandas as pd
+    from PIL import Image
+
+    if len(coords) == 0:
+        return '', float('nan'), None
+    placements, canvases = pack([(w, h) for _, _, w, h in coords], width, height, gap)
+    if verbose: print(f'packed {len(coords)} regions in {len(canvases)} canvases')
+
+    pages = []
+    for c, (cw, ch) in enumerate(canvases):
+        canvas = np.full((ch, cw), 255, dtype=np.uint8)
+        for (rx, ry, w, h), (pc, px, py) in zip(coords, placements):
+            if pc == c:
+                canvas[py:py+h, px:px+w] = cv2.bitwise_not(image[ry:ry+h, rx:rx+w])
+        conditional_save(canvas, get_conditional_path(f'atlas_{c}.png', temp_folder))
+        data = get_ocr_data(Image.fromarray(canvas), engine)
+        data['page_num'] = c + 1 # keeps the paragraphs of different canvases apart
+        data['region'] = -1
+        cx, cy = data['left'] + data['width'] / 2, data['top'] + data['height'] / 2
+        for i, ((rx, ry, w, h), (pc, px, py)) in enumerate(zip(coords, placements)):
+            if pc != c:
+                continue
+            inside = (cx >= px) & (cx < px + w) & (cy >= py) & (cy < py + h)
+            data.loc[inside, 'region'] = i
+            data.loc[inside, 'left'] += rx - px
+            data.loc[inside, 'top'] += ry - py
+        pages.append(data)
+    data = pd.concat(pages, ignore_index=True)
+
+    texts = []
+    kept = []
+    words = data[data['level'] == 5]
+    for i in range(len(coords)):
+        # the words of the region and the block, paragraph and line rows they belong to
+        keys = words.loc[words['region'] == i, ['page_num', 'block_num', 'par_num']].drop_duplicates()
+        rows = data.merge(keys, on=['page_num', 'block_num', 'par_num'])
+        rows = rows[(rows['level'] < 5) | (rows['region'] == i)]
+        if len(rows) == 0:
+            continue
+        text, _, region_data = get_text(rows, min_confidence=min_confidence)
+        if text:
+            texts.append(text)
+        kept.append(region_data[region_data['level'] == 5])
+    conf = words[words['conf'] > -1]['conf'].mean()
+    return '\n\n'.join(texts), conf, pd.concat(kept, ignore_index=True) if kept else words.iloc[:0]
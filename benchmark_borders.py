@@ -0,0 +1,47 @@
+import glob
+import time
+from argparse import ArgumentParser
+
+import utils
+from image_prep import grayscale
+from image_processing import crop_margins, crop_to_page
+
+def benchmark(crop, image, repeat: int = 1) -> dict:
+    '''Time the hough and projection methods of a crop function on one image.
+
+    Args:
+        crop (callable): crop_to_page or crop_margins
+        image (cv2 image): grayscale image to crop
+        repeat (int): number of runs to average the time over
+
+    Returns:
+        dict: seconds and coordinates for each method
+    '''
+    results = {}
+    for method in ['hough', 'projection']:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            _, coords = crop(image, method=method)
+        results[method] = ((time.perf_counter() - start) / repeat, tuple(int(c) for c in coords))
+    return results
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare the Hough and the projection border detectors on scanned pages.')
+    parser.add_argument('--repeat', '-r', type=int, default=1, help='number of runs per image and method. default=1')
+    parser.add_argument('input', nargs='+', help='page images, e.g. the cropped.png files in ./temp')
+    args = parser.parse_args()
+
+    files = [f for pattern in args.input for f in glob.glob(pattern)]
+    print('image\tfunction\though_seconds\tprojection_seconds\tspeedup\tmax_difference\though\tprojection')
+    for path in files:
+        image = grayscale(utils.load_image(path))
+        for crop in [crop_to_page, crop_margins]:
+            try:
+                results = benchmark(crop, image, args.repeat)
+            except (ValueError, TypeError) as e:
+                # the Hough path fails when it finds no lines at all
+                print(f'{path}\t{crop.__name__}\tfailed: {e}')
+                continue
+            (th, ch), (tp, cp) = results['hough'], results['projection']
+            diff = max(abs(a - b) for a, b in zip(ch, cp))
+            print(f'{path}\t{crop.__name__}\t{th:.3f}\t{tp:.3f}\t{th / tp:.1f}\t{diff}\t{ch}\t{cp}')
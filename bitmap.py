@@ -0,0 +1,163 @@
+import numpy as np
+
+# number of set bits of each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def get_bit_mask(start: int, end: int) -> np.ndarray:
+    '''Build the byte mask selecting the bits in the interval [start, end).
+
+    Args:
+        start (int): first bit, counting from the most significant bit of the first byte
+        end (int): bit after the last one
+
+    Returns:
+        np.ndarray: one uint8 mask for each byte from start // 8 to (end - 1) // 8
+    '''
+    mask = np.full((end - 1) // 8 - start // 8 + 1, 0xFF, dtype=np.uint8)
+    mask[0] &= 0xFF >> (start % 8)
+    mask[-1] &= (0xFF << (7 - (end - 1) % 8)) & 0xFF
+    return mask
+
+
+class Bitmap:
+    '''Binary image packed with 1 bit per pixel.
+
+    Rows are packed with np.packbits, so a page takes 8 times less memory than
+    the uint8 image. Slicing with [y1:y2, x1:x2] returns a view sharing the same
+    buffer, like numpy does, and the projections are computed on the packed
+    bytes with a popcount table.
+
+    Args:
+        bits (np.ndarray): packed rows, uint8 array of shape (h, ceil((offset + width) / 8))
+        width (int): width of the image in pixels
+        offset (int): bit of the first byte where column 0 starts. default=0
+    '''
+    def __init__(self, bits: np.ndarray, width: int, offset: int = 0):
+        self.bits = bits
+        self.width = width
+        self.offset = offset
+
+    @classmethod
+    def from_image(cls, img) -> 'Bitmap':
+        '''Pack an image, any pixel > 0 is set.'''
+        return cls(np.packbits(img > 0, axis=1), img.shape[1])
+
+    @classmethod
+    def zeros(cls, shape: 'tuple[int, int]') -> 'Bitmap':
+        '''Create an empty bitmap of shape (h, w).'''
+        return cls(np.zeros((shape[0], (shape[1] + 7) // 8), dtype=np.uint8), shape[1])
+
+    @property
+    def shape(self) -> 'tuple[int, int]':
+        return (self.bits.shape[0], self.width)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def to_bool(self) -> np.ndarray:
+        '''Unpack into a boolean array of shape (h, w).'''
+        if self.width == 0:
+            return np.zeros(self.shape, dtype=bool)
+        bits = np.unpackbits(self.bits, axis=1, count=self.offset + self.width)
+        return bits[:, self.offset:].astype(bool)
+
+    def to_image(self, value: int = 255) -> np.ndarray:
+        '''Unpack into a uint8 image with the set pixels equal to value.'''
+        return self.to_bool().astype(np.uint8) * np.uint8(value)
+
+    def count(self, axis: int = None):
+        '''Count the set pixels, the same as np.sum(img > 0, axis).
+
+        Args:
+            axis (int): 0 to count each column, 1 to count each row, None for the whole bitmap. default=None
+
+        Returns:
+            np.ndarray or int: the pixel counts
+        '''
+        h = self.bits.shape[0]
+        if self.width == 0 or h == 0:
+            counts = np.zeros(self.width if axis == 0 else h, dtype=int)
+            return counts if axis is not None else 0
+
+        if axis == 0:
+            counts = np.zeros(self.bits.shape[1] * 8, dtype=int)
+            for b in range(8):
+                counts[b::8] = ((self.bits >> (7 - b)) & 1).sum(axis=0)
+            return counts[self.offset:self.offset + self.width]
+
+        counts = POPCOUNT[self.bits].sum(axis=1, dtype=int)
+        if self.offset > 0:
+            counts -= POPCOUNT[self.bits[:, 0] & ((0xFF << (8 - self.offset)) & 0xFF)]
+        tail = self.bits.shape[1] * 8 - self.offset - self.width
+        if tail > 0:
+            counts -= POPCOUNT[self.bits[:, -1] & ((1 << tail) - 1)]
+        return counts if axis is not None else int(counts.sum())
+
+    def any(self) -> bool:
+        return self.count() > 0
+
+    def aligned(self) -> np.ndarray:
+        '''Get the packed rows starting at bit 0, with the bits after the width cleared.
+
+        Returns:
+            np.ndarray: new uint8 array of shape (h, ceil(w / 8))
+        '''
+        n = (self.width + 7) // 8
+        if self.offset == 0:
+            bits = self.bits[:, :n].copy()
+        else:
+            bits = (self.bits[:, :n] << self.offset) & 0xFF
+            nxt = np.zeros_like(bits)
+            nxt[:, :self.bits.shape[1] - 1] = self.bits[:, 1:n + 1] >> (8 - self.offset)
+            bits |= nxt
+        if self.width % 8 > 0:
+            bits[:, -1] &= (0xFF << (8 - self.width % 8)) & 0xFF
+        return bits
+
+    def copy(self) -> 'Bitmap':
+        return Bitmap(self.aligned(), self.width)
+
+    def fill(self, x1: int, y1: int, x2: int, y2: int, value: bool = False):
+        '''Set or clear every pixel in the rectangle [x1, x2) x [y1, y2), clipped to the bitmap.'''
+        x1, x2 = max(x1, 0), min(x2, self.width)
+        y1, y2 = max(y1, 0), min(y2, self.bits.shape[0])
+        if x1 >= x2 or y1 >= y2:
+            return
+        start, end = self.offset + x1, self.offset + x2
+        mask = get_bit_mask(start, end)
+        block = self.bits[y1:y2, start // 8:(end - 1) // 8 + 1]
+        if value:
+            block |= mask
+        else:
+            block &= ~mask
+
+    def _view(self, key) -> 'Bitmap':
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        y1, y2, _ = rows.indices(self.bits.shape[0])
+        x1, x2, _ = cols.indices(self.width)
+        x2 = max(x1, x2)
+        start, end = self.offset + x1, self.offset + x2
+        last = (end + 7) // 8 if end > start else start // 8
+        return Bitmap(self.bits[y1:y2, start // 8:last], x2 - x1, start % 8)
+
+    def __getitem__(self, key) -> 'Bitmap':
+        return self._view(key)
+
+    def __setitem__(self, key, value: 'Bitmap'):
+        target = self._view(key)
+        if target.shape != value.shape:
+            raise ValueError(f'could not paste bitmap of shape {value.shape} into {target.shape}')
+        if target.width == 0:
+            return
+        src = value.aligned()
+        o = target.offset
+        if o > 0:
+            padded = np.zeros((src.shape[0], src.shape[1] + 2), dtype=np.uint16)
+            padded[:, 1:-1] = src
+            words = (padded[:, :-1] << 8) | padded[:, 1:]
+            src = ((words >> o) & 0xFF).astype(np.uint8)
+        src = src[:, :target.bits.shape[1]]
+        mask = get_bit_mask(o, o + target.width)
+        target.bits[:] = (target.bits & ~mask) | (src & mask)
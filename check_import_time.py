@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# modules imported by the command line entry points
+MODULES = ['main', 'utils', 'image_prep', 'image_processing', 'mhs_layout_analisys', 'process_pdfs', 'job_queue', 'page_io', 'profiling',
+           'daemon', 'dedup', 'metrics', 'atlas', 'sweep', 'text_index', 'edition_store', 'triage', 'evaluate_quality']
+# dependencies that must only be imported by the code that uses them
+HEAVY = ['matplotlib', 'pandas', 'scipy', 'pytesseract', 'pdf2image', 'PIL', 'nltk']
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+def measure_import(module: str, heavy: 'list[str]' = HEAVY) -> 'tuple[float, list[str]]':
+    '''Import a module in a fresh interpreter.
+
+    Args:
+        module (str): name of the module
+        heavy (list[str]): dependencies to look for after the import. default=HEAVY
+
+    Returns:
+        tuple(float, list[str]): seconds the import took and heavy dependencies it loaded
+
+    Raises:
+        ImportError: if the module can not be imported
+    '''
+    result = subprocess.run([sys.executable, '-c', SCRIPT.format(module=module, heavy=heavy)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().split('\n')[-1])
+    lines = result.stdout.split('\n')
+    return float(lines[0]), lines[1].split()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Fail if importing the pipeline modules is slow or loads heavy dependencies.')
+    parser.add_argument('--budget', type=float, default=1.0, help='maximum seconds to import each module. default=1')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='number of imports per module, the fastest is kept. default=3')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='modules to import. defaults to the pipeline modules')
+    args = parser.parse_args()
+
+    failed = False
+    print('module\tseconds\theavy_imports')
+    for module in args.modules:
+        try:
+            results = [measure_import(module) for _ in range(args.repeat)]
+        except ImportError as e:
+            failed = True
+            print(f'{module}\tfailed: {e}')
+            continue
+        seconds, loaded = min(results)
+        slow = seconds > args.budget
+        failed = failed or slow or len(loaded) > 0
+        print(f'{module}\t{seconds:.3f}{" over budget" if slow else ""}\t{",".join(loaded)}')
+    sys.exit(1 if failed else 0)
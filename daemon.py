@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+import urllib.request
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from image_prep import deskew, prepare_image
+from image_processing import extract_page
+import utils
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+DEFAULT_PORT = 8765
+
+class OCRService:
+    '''Pipeline kept loaded in memory, running pages on a pool of worker threads.
+
+    Each worker thread keeps its own tesseract instance when tesserocr is
+    installed, so the language data is loaded once per thread instead of
+    once per page; otherwise every page runs the tesseract command. OpenCV
+    and tesseract release the GIL, so the threads run pages in parallel.
+
+    Args:
+        workers (int): number of pages processed at the same time. default=os.cpu_count()
+        detection_scale (float): scale of the image used to detect the page before cropping. default=1
+        tile_size (int): run the image filters in parallel tiles of this size, does not tile if equals None. default=None
+        input_root (str): folder the requested page images must be in. default=the current folder
+        output_root (str): folder the requested text outputs must be in, texts are only returned if equals None. default=None
+    '''
+    def __init__(self, workers: int = None, detection_scale: float = 1.0, tile_size: int = None, input_root: str = '.', output_root: str = None):
+        self.input_root = os.path.realpath(input_root)
+        self.output_root = None if output_root is None else os.path.realpath(output_root)
+        self.detection_scale = detection_scale
+        self.tile_size = tile_size
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+
+    def get_engine(self):
+        '''Get the tesseract instance of the current thread, None without tesserocr.'''
+        if tesserocr is None:
+            return None
+        if not hasattr(self.local, 'engine'):
+            self.local.engine = tesserocr.PyTessBaseAPI(lang='por')
+        return self.local.engine
+
+    def resolve(self, path: str, root: str) -> str:
+        '''Get the real path of a requested file, relative to a root folder.
+
+        Raises:
+            PermissionError: if the path, with its symbolic links resolved, is outside the root
+        '''
+        path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([path, root]) != root:
+            raise PermissionError(f'"{path}" is outside "{root}"')
+        return path
+
+    def process(self, request: dict) -> dict:
+        '''Run the pipeline on a page.
+
+        Args:
+            request (dict): "path" of the page image, within input_root; "prepare" false to skip cropping, binarization and deskewing of an already prepared image; "output" path to also write the text to, within output_root
+
+        Returns:
+            dict: "text", mean "confidence" and "seconds" spent on the page
+
+        Raises:
+            PermissionError: if a path is outside its root, or an output is requested without output_root
+        '''
+        start = time.perf_counter()
+        path = self.resolve(request['path'], self.input_root)
+        output = request.get('output')
+        if output:
+            if self.output_root is None:
+                raise PermissionError('the daemon does not write outputs, start it with --output-root')
+            output = self.resolve(output, self.output_root)
+        image = utils.load_image(path)
+        if request.get('prepare', True):
+            image, _ = extract_page(image, scale=self.detection_scale)
+            image = prepare_image(image, rotate=False, tile_size=self.tile_size)
+            image = deskew(image, passes=2, tile_size=self.tile_size)
+        text, confidence = utils.run_ocr(image, output, treat_confidence=True, engine=self.get_engine())
+        return { 'text': text, 'confidence': float(confidence), 'seconds': time.perf_counter() - start }
+
+    def submit(self, request: dict) -> dict:
+        '''Run a page on the worker pool and wait for the result.'''
+        return self.executor.submit(self.process, request).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class OCRHandler(BaseHTTPRequestHandler):
+    '''Answer GET /health and POST /ocr with a JSON request, see OCRService.process.'''
+    service = None
+
+    def send_json(self, status: int, content: dict):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, { 'error': f'unknown path "{self.path}"' })
+            return
+        self.send_json(200, { 'status': 'ok', 'tesserocr': tesserocr is not None })
+
+    def do_POST(self):
+        if self.path != '/ocr':
+            self.send_json(404, { 'error': f'unknown path "{self.path}"' })
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if 'path' not in request:
+                raise ValueError('missing "path" of the page image')
+        except ValueError as e:
+            self.send_json(400, { 'error': str(e) })
+            return
+        try:
+            self.send_json(200, self.service.submit(request))
+        except PermissionError as e:
+            self.send_json(403, { 'error': str(e) })
+        except Exception as e:
+            self.send_json(500, { 'error': repr(e) })
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(service: OCRService, port: int = DEFAULT_PORT, verbose: bool = False):
+    '''Answer OCR requests on localhost until interrupted.
+
+    Args:
+        service (OCRService): loaded pipeline that runs the pages
+        port (int): port to listen to, only on localhost. default=8765
+        verbose (bool): print each request to console. default=False
+    '''
+    handler = type('Handler', (OCRHandler,), { 'service': service })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.verbose = verbose
+    if verbose:
+        print(f'listening on http://127.0.0.1:{port}, tesserocr {"loaded" if tesserocr else "not installed"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def request_ocr(path: str, port: int = DEFAULT_PORT, prepare: bool = True, output: str = None) -> dict:
+    '''Send a page to a running daemon.
+
+    Args:
+        path (str): path of the page image, as seen by the daemon, within its input root
+        port (int): port of the daemon. default=8765
+        prepare (bool): crop, binarize and deskew the page before the OCR. default=True
+        output (str): path for the daemon to write the text to, within its output root. does not save if equals None. default=None
+
+    Returns:
+        dict: "text", mean "confidence" and "seconds" spent on the page
+    '''
+    body = json.dumps({ 'path': os.path.abspath(path), 'prepare': prepare, 'output': output }).encode('utf-8')
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/ocr', data=body, headers={ 'Content-Type': 'application/json' })
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Keep the OCR pipeline loaded and answer page requests on localhost.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'port to listen to. default={DEFAULT_PORT}')
+    parser.add_argument('--workers', type=int, help='number of pages processed at the same time. defaults to the number of CPUs')
+    parser.add_argument('--detection-scale', type=float, default=1.0, help='scale of the image used to detect the page before cropping, e.g. 0.25. default=1')
+    parser.add_argument('--tile-size', type=int, help='run the image filters in parallel tiles of this size, e.g. 1024. does not tile by default.')
+    parser.add_argument('--input-root', type=str, default='.', help='folder the requested page images must be in. default=the current folder')
+    parser.add_argument('--output-root', type=str, help='folder the requested text outputs must be in. the texts are only returned if it is not given.')
+    parser.add_argument('--verbose', '-v', action='store_true', help='print each request to console.')
+    args = parser.parse_args()
+
+    serve(OCRService(args.workers, args.detection_scale, args.tile_size, args.input_root, args.output_root), args.port, args.verbose)
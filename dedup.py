@@ -0,0 +1,191 @@
+import sqlite3
+from argparse import ArgumentParser
+import cv2
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    edition TEXT NOT NULL,
+    page TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    duplicate_of TEXT,
+    thumbnail BLOB,
+    PRIMARY KEY (edition, page)
+);
+'''
+MAX_DISTANCE = 4     # pages whose hashes differ in at most this many of the 64 bits are candidate duplicates
+THUMBNAIL_SIZE = 64  # side of the grayscale thumbnails that confirm a candidate, in pixels
+MIN_SIMILARITY = 0.9 # correlation of the thumbnails above which a candidate is a duplicate
+
+def phash(image) -> int:
+    '''Compute the perceptual hash of an image.
+
+    Keeps the sign, relative to the median, of the 8x8 lowest frequencies of
+    the DCT of a 32x32 grayscale thumbnail, so rescans with different
+    resolution, compression, brightness or small crop differences get hashes
+    that differ in few bits.
+
+    Args:
+        image (cv2 image): image to hash, e.g. the result of extract_page
+
+    Returns:
+        int: 64 bit hash
+    '''
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:]) # the DC term only carries the mean brightness
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def thumbnail(image) -> np.ndarray:
+    '''Get the grayscale thumbnail of an image that confirms the duplicates found by phash.
+
+    Pages laid out on the same template, e.g. the columns of a newspaper, can
+    get hashes only a few bits apart, but differ in the lines of text that a
+    thumbnail still shows.
+
+    Args:
+        image (cv2 image): image to shrink, e.g. the result of extract_page
+
+    Returns:
+        np.ndarray: THUMBNAIL_SIZE x THUMBNAIL_SIZE uint8 image
+    '''
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    '''Get the normalized cross-correlation of two thumbnails, 1 for the same image regardless of brightness and contrast.'''
+    a = a.astype(np.float32) - a.mean()
+    b = b.astype(np.float32) - b.mean()
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / norm) if norm > 0 else float(np.array_equal(a, b))
+
+
+def to_signed(value: int) -> int:
+    '''Store a 64 bit hash in a signed SQLite integer.'''
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming(hashes: np.ndarray, value: int) -> np.ndarray:
+    '''Count the bits in which each hash differs from a value.
+
+    Args:
+        hashes (np.ndarray): hashes as uint64
+        value (int): hash to compare to
+
+    Returns:
+        np.ndarray: number of different bits for each hash
+    '''
+    diff = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class HashIndex:
+    '''Perceptual hashes of the processed pages in a SQLite file.
+
+    Args:
+        path (str): path to the SQLite file, created if it does not exist
+    '''
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(hashes)')]
+        if 'thumbnail' not in columns: # index written before the thumbnails were kept
+            with self.connection:
+                self.connection.execute('ALTER TABLE hashes ADD COLUMN thumbnail BLOB')
+
+    def load(self) -> 'tuple[list[tuple[str, str]], np.ndarray]':
+        '''Get the edition and page names and the hashes (uint64) of every page.'''
+        rows = self.connection.execute('SELECT edition, page, hash FROM hashes ORDER BY rowid').fetchall()
+        return [(e, p) for e, p, _ in rows], np.array([h for _, _, h in rows], dtype=np.int64).view(np.uint64)
+
+    def get_thumbnail(self, edition: str, page: str) -> np.ndarray:
+        '''Get the thumbnail of a page, None if it has none.'''
+        row = self.connection.execute('SELECT thumbnail FROM hashes WHERE edition = ? AND page = ?', (edition, page)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.uint8).reshape(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+
+    def find(self, edition: str, page: str, value: int, thumb: np.ndarray, max_distance: int = MAX_DISTANCE,
+             min_similarity: float = MIN_SIMILARITY) -> 'tuple[str, str, int]':
+        '''Find the closest other page to a hash whose thumbnail confirms it.
+
+        Args:
+            edition (str): edition name of the page, excluded from the search
+            page (str): page name of the page, excluded from the search
+            value (int): hash of the page
+            thumb (np.ndarray): thumbnail of the page, see thumbnail
+            max_distance (int): number of different bits up to which pages are candidate duplicates. default=MAX_DISTANCE
+            min_similarity (float): correlation of the thumbnails above which a candidate is a duplicate. default=MIN_SIMILARITY
+
+        Returns:
+            tuple[str, str, int]: edition, page and distance of the closest page, None if no page is close enough
+        '''
+        names, hashes = self.load()
+        if len(names) == 0:
+            return None
+        distances = hamming(hashes, value)
+        for i in np.argsort(distances, kind='stable'):
+            if distances[i] > max_distance:
+                break
+            if names[i] == (edition, page):
+                continue
+            other = self.get_thumbnail(*names[i])
+            if other is not None and similarity(thumb, other) >= min_similarity:
+                return (*names[i], int(distances[i]))
+        return None
+
+    def add(self, edition: str, page: str, value: int, thumb: np.ndarray = None, duplicate_of: 'tuple[str, str]' = None):
+        '''Store, or replace, the hash and thumbnail of a page and the page it duplicates, if any.'''
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO hashes (edition, page, hash, duplicate_of, thumbnail) VALUES (?, ?, ?, ?, ?)',
+                                    (edition, page, to_signed(value), '/'.join(duplicate_of) if duplicate_of else None,
+                                     None if thumb is None else thumb.tobytes()))
+
+    def clusters(self, max_distance: int = MAX_DISTANCE, min_similarity: float = MIN_SIMILARITY) -> 'list[list[tuple[str, str]]]':
+        '''Group the pages that are duplicates of each other, directly or through other pages.
+
+        Args:
+            max_distance (int): number of different bits up to which pages are candidate duplicates. default=MAX_DISTANCE
+            min_similarity (float): correlation of the thumbnails above which a candidate is a duplicate. default=MIN_SIMILARITY
+
+        Returns:
+            list[list[tuple[str, str]]]: edition and page names of each group with more than one page
+        '''
+        names, hashes = self.load()
+        parent = list(range(len(names)))
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        thumbs = [self.get_thumbnail(*name) for name in names]
+        for i in range(len(names)):
+            for j in np.flatnonzero(hamming(hashes[i+1:], int(hashes[i])) <= max_distance) + i + 1:
+                if thumbs[i] is not None and thumbs[j] is not None and similarity(thumbs[i], thumbs[j]) >= min_similarity:
+                    parent[root(j)] = root(i)
+        groups = {}
+        for i in range(len(names)):
+            groups.setdefault(root(i), []).append(names[i])
+        return [g for g in groups.values() if len(g) > 1]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Report the groups of duplicate pages found in a hash index.')
+    parser.add_argument('--distance', '-d', type=int, default=MAX_DISTANCE, help=f'number of different bits, out of 64, up to which pages are candidate duplicates. default={MAX_DISTANCE}')
+    parser.add_argument('--similarity', '-s', type=float, default=MIN_SIMILARITY, help=f'correlation of the thumbnails, up to 1, above which candidates are duplicates. default={MIN_SIMILARITY}')
+    parser.add_argument('index', help='path to the hash index file')
+    args = parser.parse_args()
+
+    index = HashIndex(args.index)
+    clusters = index.clusters(args.distance, args.similarity)
+    print('cluster\tedition\tpage')
+    for i, cluster in enumerate(clusters):
+        for edition, page in cluster:
+            print(f'{i}\t{edition}\t{page}')
+    index.close()
@@ -0,0 +1,141 @@
+import glob
+import json
+import os
+import sqlite3
+from argparse import ArgumentParser
+import cv2
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS texts (
+    page TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    text TEXT NOT NULL,
+    confidence REAL,
+    words TEXT,
+    PRIMARY KEY (page, variant)
+);
+CREATE TABLE IF NOT EXISTS thumbnails (
+    page TEXT PRIMARY KEY,
+    image BLOB NOT NULL
+);
+'''
+THUMBNAIL_WIDTH = 400 # width of the page thumbnails, in pixels
+
+def get_store_path(folder: str, edition: str) -> str:
+    '''Get the path of the store of an edition.'''
+    return os.path.join(folder, f'{edition}.sqlite')
+
+
+def get_words(data) -> 'list[list]':
+    '''Get the boxes of the words in the tesseract output of utils.run_ocr.
+
+    Args:
+        data (pd.DataFrame): word rows returned by run_ocr with return_data
+
+    Returns:
+        list[list]: left, top, width, height, confidence and text of each word
+    '''
+    return [[int(w['left']), int(w['top']), int(w['width']), int(w['height']), float(w['conf']), str(w['text']).strip()]
+            for _, w in data.iterrows() if str(w['text']).strip()]
+
+
+class EditionStore:
+    '''All the output of an edition in a single SQLite file.
+
+    Holds the text, mean confidence and word boxes of each page and OCR
+    variant, and optionally a JPEG thumbnail of each page, with random access
+    by page. Replaces the output/<edition>/<page>/ folders, see export.
+
+    Args:
+        path (str): path to the SQLite file, created if it does not exist
+    '''
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def put_text(self, page: str, text: str, confidence: float = None, words: 'list[list]' = None, variant: str = 'proc'):
+        '''Store, or replace, the text of a page.
+
+        Args:
+            page (str): page name
+            text (str): text of the page
+            confidence (float): mean confidence of the text. default=None
+            words (list[list]): word boxes, see get_words. default=None
+            variant (str): name of the text file it replaces, e.g. proc, base or gray. default='proc'
+        '''
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO texts (page, variant, text, confidence, words) VALUES (?, ?, ?, ?, ?)',
+                                    (page, variant, text, None if confidence is None else float(confidence), None if words is None else json.dumps(words, ensure_ascii=False)))
+
+    def put_thumbnail(self, page: str, image, width: int = THUMBNAIL_WIDTH):
+        '''Store a small JPEG of a page.'''
+        scale = min(width / image.shape[1], 1)
+        small = cv2.resize(np.asarray(image), None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO thumbnails (page, image) VALUES (?, ?)', (page, cv2.imencode('.jpg', small)[1].tobytes()))
+
+    def get_text(self, page: str, variant: str = 'proc') -> 'tuple[str, float, list[list]]':
+        '''Get the text, mean confidence and word boxes of a page, None if it is not in the store.'''
+        row = self.connection.execute('SELECT text, confidence, words FROM texts WHERE page = ? AND variant = ?', (page, variant)).fetchone()
+        if row is None:
+            return None
+        text, confidence, words = row
+        return text, confidence, None if words is None else json.loads(words)
+
+    def get_thumbnail(self, page: str):
+        '''Get the thumbnail of a page as a cv2 image, None if it is not in the store.'''
+        row = self.connection.execute('SELECT image FROM thumbnails WHERE page = ?', (page,)).fetchone()
+        return None if row is None else cv2.imdecode(np.frombuffer(row[0], np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def pages(self) -> 'list[str]':
+        '''List the pages in the store.'''
+        return [page for page, in self.connection.execute('SELECT DISTINCT page FROM texts ORDER BY page')]
+
+    def export(self, output_folder: str) -> int:
+        '''Write the store in the folder layout of main.py.
+
+        Writes <output_folder>/<page>/<variant>.txt for each text, with the word
+        boxes in <variant>_words.json, and <page>/thumbnail.jpg.
+
+        Args:
+            output_folder (str): folder of the edition, e.g. ./output/<edition>
+
+        Returns:
+            int: number of texts written
+        '''
+        count = 0
+        for page, variant, text, words in self.connection.execute('SELECT page, variant, text, words FROM texts'):
+            os.makedirs(os.path.join(output_folder, page), exist_ok=True)
+            with open(os.path.join(output_folder, page, f'{variant}.txt'), 'w', encoding='utf-8') as f:
+                f.write(text)
+            if words is not None:
+                with open(os.path.join(output_folder, page, f'{variant}_words.json'), 'w', encoding='utf-8') as f:
+                    f.write(words)
+            count += 1
+        for page, image in self.connection.execute('SELECT page, image FROM thumbnails'):
+            os.makedirs(os.path.join(output_folder, page), exist_ok=True)
+            with open(os.path.join(output_folder, page, 'thumbnail.jpg'), 'wb') as f:
+                f.write(image)
+        return count
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='List or export the per edition output stores.')
+    parser.add_argument('--output', '-o', type=str, help='export each store to <output>/<edition>/<page>/ instead of listing its pages.')
+    parser.add_argument('stores', nargs='+', help='store files, e.g. ./output/*.sqlite')
+    args = parser.parse_args()
+
+    for path in [f for pattern in args.stores for f in glob.glob(pattern)]:
+        edition = os.path.splitext(os.path.basename(path))[0]
+        store = EditionStore(path)
+        if args.output:
+            print(f'{edition}: exported {store.export(os.path.join(args.output, edition))} texts')
+        else:
+            for page in store.pages():
+                text, confidence, _ = store.get_text(page) or ('', None, None)
+                print(f'{edition}\t{page}\t{len(text)}\t{confidence}')
+        store.close()
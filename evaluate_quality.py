@@ -1,13 +1,13 @@
 import os
 import re
 import glob
-import pandas as pd
 from unidecode import unidecode
-from nltk.metrics.distance import edit_distance
 
 import utils
 
 def count_characters(output_path='quality.tsv'):
+    import pandas as pd
+
     all_files = []
 
     editions = glob.glob('./output/*')
@@ -46,6 +46,8 @@ def count_characters(output_path='quality.tsv'):
     df.to_csv(output_path, index=False, sep='\t')
 
 def char_accuracy(ground_truth: str, recognized: str, ignore_accents: bool = True, ignore_newline: bool = True, ignore_symbols: bool = True) -> float:
+    from nltk.metrics.distance import edit_distance
+
     ground_truth = ground_truth.lower()
     recognized = recognized.lower()
     if ignore_accents:
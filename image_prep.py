@@ -2,22 +2,25 @@ import cv2
 import numpy as np
 import os
 from utils import conditional_save
+from tiling import process_tiled
 
-def grayscale(image, save_to: str = None):
+def grayscale(image, save_to: str = None, tile_size: int = None):
     '''Make the image grayscale.
 
     Args:
         image (cv2 image): base image to convert
         save_to (str): path to save the image, does not save if it equals None. default=None
+        tile_size (int): process the image in tiles of this size in parallel, does not tile if equals None. default=None
     
     Returns:
         processed image in cv2 image format
     '''
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    convert = lambda im: cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    image = process_tiled(image, convert, 0, tile_size) if tile_size else convert(image)
     conditional_save(image, save_to)
     return image
 
-def black_and_white(image, maxval: int = 255, block_size: int = 45, save_to: str = None):
+def black_and_white(image, maxval: int = 255, block_size: int = 45, save_to: str = None, tile_size: int = None):
     '''Make the image black and white using adaptive thresholding.
 
     Args:
@@ -25,15 +28,17 @@ def black_and_white(image, maxval: int = 255, block_size: int = 45, save_to: str
         maxval (int): maxval to pass to OpenCV, default=255
         block_size (int): size of the block to use when thresholding. Must be odd, default=45
         save_to (str): path to save the image, does not save if it equals None. default=None
+        tile_size (int): process the image in tiles of this size in parallel, does not tile if equals None. default=None
 
     Returns:
         processed image in cv2 image format
     '''
-    image = cv2.adaptiveThreshold(image, maxval, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, 10)
+    threshold = lambda im: cv2.adaptiveThreshold(im, maxval, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, 10)
+    image = process_tiled(image, threshold, block_size // 2, tile_size) if tile_size else threshold(image)
     conditional_save(image, save_to)
     return image
 
-def remove_noise(image, kernel_size: 'tuple[int, int]' = (2, 2), median_blur_k: int = 3, save_to: str = None):
+def remove_noise(image, kernel_size: 'tuple[int, int]' = (2, 2), median_blur_k: int = 3, save_to: str = None, tile_size: int = None):
     '''Remove noisy pixels from an image using morphological closing followed by a median filter.
 
     Args:
@@ -41,17 +46,22 @@ def remove_noise(image, kernel_size: 'tuple[int, int]' = (2, 2), median_blur_k:
         kernel_size (tuple[int, int]): kernel_size to pass to OpenCV, default=(1,1)
         median_blur_k (int): k-size for the medianBlur to passo to OpenCV, default=3
         save_to (str): path to save the image, does not save if it equals None. default=None
+        tile_size (int): process the image in tiles of this size in parallel, does not tile if equals None. default=None
 
     Returns:
         processed image in cv2 image format
     '''
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, kernel_size)
-    image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel)
-    image = cv2.medianBlur(image, median_blur_k)
+    def denoise(im):
+        im = cv2.morphologyEx(im, cv2.MORPH_CLOSE, kernel)
+        return cv2.medianBlur(im, median_blur_k)
+    # the closing is a dilation followed by an erosion, each one reaching up to a kernel size away
+    halo = 2 * max(kernel_size) + median_blur_k // 2
+    image = process_tiled(image, denoise, halo, tile_size) if tile_size else denoise(image)
     conditional_save(image, save_to)
     return image
 
-def prepare_image(image, output_path: str = None, temp_folder: str = None, binarize: bool = True, rotate: bool = True, denoise: bool = False, verbose: bool = False):
+def prepare_image(image, output_path: str = None, temp_folder: str = None, binarize: bool = True, rotate: bool = True, denoise: bool = False, verbose: bool = False, tile_size: int = None, block_size: int = 45, skew_scale: float = 1.0):
     '''
     Apply selected preparations to an image.
 
@@ -62,6 +72,9 @@ def prepare_image(image, output_path: str = None, temp_folder: str = None, binar
         binarize (bool): flag to convert the image to black and white, default=True
         remove_noise (bool): flag to remove noise from the image, default=False
         verbose (bool): print extra information to console?
+        tile_size (int): run the filters in parallel tiles of this size, does not tile if equals None. default=None
+        block_size (int): size of the block used by black_and_white. Must be odd, default=45
+        skew_scale (float): scale of the image used to estimate the skew, see get_skew_angle. default=1.0
     
     Returns:
         processed image in cv2 image format
@@ -70,30 +83,30 @@ def prepare_image(image, output_path: str = None, temp_folder: str = None, binar
         save_to = os.path.join(temp_folder, 'grayscale.png') if temp_folder else None
         if verbose:
             print('converting to grayscale...', f'saving temp file to "{save_to}"' if save_to else '')
-        image = grayscale(image, save_to)
+        image = grayscale(image, save_to, tile_size=tile_size)
 
         save_to = os.path.join(temp_folder, 'black_and_white.png') if temp_folder else None
         if verbose:
             print('converting to black and white...', f'saving temp file to "{save_to}"' if save_to else '')
-        image = black_and_white(image, save_to=save_to)
+        image = black_and_white(image, block_size=block_size, save_to=save_to, tile_size=tile_size)
     
     if rotate:
         save_to = os.path.join(temp_folder, 'rotate.png') if temp_folder else None
         if verbose:
             print('rotating...', f'saving temp file to "{save_to}"' if save_to else '')
-        image = deskew(image)
+        image = deskew(image, tile_size=tile_size, scale=skew_scale)
         conditional_save(image, save_to)
 
     if denoise:
         save_to = os.path.join(temp_folder, 'remove_noise.png') if temp_folder else None
         if verbose:
             print('removing pixel noise...', f'saving temp file to "{save_to}"' if save_to else '')
-        image = remove_noise(image, save_to=save_to)
+        image = remove_noise(image, save_to=save_to, tile_size=tile_size)
     
     if output_path:
         if verbose:
             print(f'saving final image to "{output_path}"')
-        cv2.imwrite(output_path, image)
+        conditional_save(image, output_path)
     
     return image
 
@@ -119,11 +132,13 @@ def get_contour_angle(contour) -> float:
     return -angle
 
 
-def get_skew_angle(cvImage) -> float:
+def get_skew_angle(cvImage, tile_size: int = None, scale: float = 1.0) -> float:
     '''Get the angle to which an image is skewed.
 
     Args:
         cvImage (cv2 image): image to find the skew angle
+        tile_size (int): run the blur in parallel tiles of this size, does not tile if equals None. default=None
+        scale (float): scale in which to estimate the angle, e.g. 0.5. Uniform scaling keeps the angles. default=1.0
     
     Returns:
         float: skew angle in degrees
@@ -131,8 +146,11 @@ def get_skew_angle(cvImage) -> float:
     Remarks:
         https://becominghuman.ai/how-to-automatically-deskew-straighten-a-text-image-using-opencv-a0c30aed83df
     '''
+    if scale != 1.0:
+        cvImage = cv2.resize(cvImage, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     # Prep image, copy, convert to gray scale, blur, and threshold
-    blur = cv2.GaussianBlur(cvImage, (9, 9), 0)
+    gaussian = lambda im: cv2.GaussianBlur(im, (9, 9), 0)
+    blur = process_tiled(cvImage, gaussian, 4, tile_size) if tile_size else gaussian(cvImage)
     thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
 
     # Apply dilate to merge text into meaningful lines/paragraphs.
@@ -165,6 +183,81 @@ def get_skew_angle(cvImage) -> float:
     # return -1.0 * angle
 
 
+def get_rotation_matrix(shape: 'tuple[int, int]', angle: float) -> np.ndarray:
+    '''Get the affine matrix that rotates an image around its center.
+
+    Args:
+        shape (tuple[int, int]): shape of the image to rotate (h, w)
+        angle (float): angle to rotate image by
+
+    Returns:
+        np.ndarray: 3x3 affine matrix of the rotation
+    '''
+    (h, w) = shape[:2]
+    center = (w // 2, h // 2)
+    return np.vstack([cv2.getRotationMatrix2D(center, angle, 1.0), [0, 0, 1]])
+
+
+def get_translation_matrix(dx: float, dy: float) -> np.ndarray:
+    '''Get the affine matrix that translates an image.
+
+    A crop of the region starting at (x, y) is a translation by (-x, -y).
+
+    Args:
+        dx (float): translation in the x axis
+        dy (float): translation in the y axis
+
+    Returns:
+        np.ndarray: 3x3 affine matrix of the translation
+    '''
+    return np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype=np.float64)
+
+
+def get_scale_matrix(scale: float) -> np.ndarray:
+    '''Get the affine matrix that scales an image.
+
+    Args:
+        scale (float): scale factor for both axes
+
+    Returns:
+        np.ndarray: 3x3 affine matrix of the scaling
+    '''
+    return np.array([[scale, 0, 0], [0, scale, 0], [0, 0, 1]], dtype=np.float64)
+
+
+def transform_points(points, M: np.ndarray) -> np.ndarray:
+    '''Apply an affine transform to a set of points (e.g. a contour).
+
+    Args:
+        points (np.ndarray): points in the OpenCV contour format
+        M (np.ndarray): 3x3 affine matrix
+
+    Returns:
+        np.ndarray: transformed points, same format as the input
+    '''
+    return cv2.transform(points.astype(np.float32), M[:2])
+
+
+def apply_transform(cvImage, M: np.ndarray, size: 'tuple[int, int]' = None, interpolation: int = cv2.INTER_CUBIC):
+    '''Resample an image with an accumulated affine transform.
+
+    Crops and rotations composed with the matrix product should be applied
+    with a single call to this function, so the image is only interpolated once.
+
+    Args:
+        cvImage (cv2 image): image to transform
+        M (np.ndarray): 3x3 affine matrix
+        size (tuple[int, int]): size (w, h) of the output image, defaults to the size of the input
+        interpolation (int): OpenCV interpolation flag. default=cv2.INTER_CUBIC
+
+    Returns:
+        cv2 image: transformed image
+    '''
+    if size is None:
+        size = (cvImage.shape[1], cvImage.shape[0])
+    return cv2.warpAffine(cvImage, M[:2], size, flags=interpolation, borderMode=cv2.BORDER_REPLICATE)
+
+
 def rotate_image(cvImage, angle: float):
     '''Rotate the image around its center.
     
@@ -178,22 +271,48 @@ def rotate_image(cvImage, angle: float):
     Remarks:
         https://becominghuman.ai/how-to-automatically-deskew-straighten-a-text-image-using-opencv-a0c30aed83df
     '''
-    newImage = cvImage.copy()
-    (h, w) = newImage.shape[:2]
-    center = (w // 2, h // 2)
-    M = cv2.getRotationMatrix2D(center, angle, 1.0)
-    newImage = cv2.warpAffine(newImage, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-    return newImage
+    return apply_transform(cvImage, get_rotation_matrix(cvImage.shape, angle))
+
+
+def get_deskew_angle(cvImage, passes: int = 1, tile_size: int = None, scale: float = 1.0) -> float:
+    '''Get the total rotation needed to deskew an image.
+
+    Each extra pass estimates the residual skew on a nearest neighbour preview
+    of the previous rotation, so the angles can be added up and the image
+    itself only needs to be resampled once.
+
+    Args:
+        cvImage (cv2 image): image to deskew
+        passes (int): number of times to estimate the skew. default=1
+        tile_size (int): see get_skew_angle. default=None
+        scale (float): scale in which to estimate the angles, see get_skew_angle. default=1.0
+
+    Returns:
+        float: angle to pass to rotate_image, 0 if the image is not skewed
+    '''
+    total = 0.0
+    preview = cvImage
+    for i in range(passes):
+        angle = get_skew_angle(preview, tile_size, scale)
+        if angle <= -35 or angle >= 35:
+            break
+        total -= angle
+        if i + 1 < passes:
+            preview = apply_transform(cvImage, get_rotation_matrix(cvImage.shape, total), interpolation=cv2.INTER_NEAREST)
+    return total
 
 
-def deskew(cvImage):
+def deskew(cvImage, passes: int = 1, tile_size: int = None, scale: float = 1.0):
     '''Deskew image
 
     Args:
         cvImage (cv2 image): image to deskew
+        passes (int): number of skew estimations to accumulate before rotating. default=1
+        tile_size (int): see get_skew_angle. default=None
+        scale (float): scale in which to estimate the skew, see get_skew_angle. default=1.0
     
     Returns:
         cv2 image: image rotated to be upright
     '''
-    angle = get_skew_angle(cvImage)
-    return rotate_image(cvImage, -1.0 * angle) if angle > -35 and angle < 35 else cvImage
+    angle = get_deskew_angle(cvImage, passes, tile_size, scale)
+    return rotate_image(cvImage, angle) if angle != 0 else cvImage
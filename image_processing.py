@@ -1,7 +1,5 @@
-from numpy.lib.function_base import disp
-from image_prep import remove_noise, get_contour_angle, rotate_image
+from image_prep import remove_noise, get_contour_angle, get_rotation_matrix, get_translation_matrix, get_scale_matrix, transform_points, apply_transform
 from utils import conditional_save, get_conditional_path
-from scipy.signal import find_peaks
 import numpy as np
 import cv2
 import os
@@ -28,8 +26,7 @@ def detect_main_body(image, output_path: str = None, temp_folder: str = None):
     
     cnts = cv2.findContours(dilate, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cnts = cnts[0] if len(cnts) == 2 else cnts[1]
-    cnts = sorted(cnts, key=lambda x: cv2.contourArea(x))
-    cnt = cnts[-1] # select largest
+    cnt = max(cnts, key=cv2.contourArea) # select largest
     x, y, w, h = cv2.boundingRect(cnt)
 
     img_main = image[y:y+h, x:x+w]
@@ -117,13 +114,145 @@ def detect_columns(image, output_folder: str = None, temp_folder: str = None, ve
     return column_images, columns
 
 
-def crop_margins(image, temp_folder: str = None, output_path: str = None) -> tuple:
+def get_runs(flags: np.ndarray) -> 'list[tuple[int, int]]':
+    '''Find the runs of True values in a boolean vector.
+
+    Args:
+        flags (np.ndarray): boolean vector
+    
+    Returns:
+        list[tuple[int, int]]: start and end (exclusive) of each run
+    '''
+    edges = np.diff(np.concatenate([[0], flags.astype(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def detect_columns_projection(image, output_folder: str = None, temp_folder: str = None, min_gutter: int = 20, max_rule: int = 10, verbose: bool = False):
+    '''Detect columns of text in an image by finding the gutters between them.
+
+    The gutters are the runs of (almost) empty columns in the vertical
+    projection of the ink. A thin column rule inside a gutter, narrower than
+    max_rule, does not split it. Unlike detect_columns, the analysis is linear
+    in the page width and the columns are returned as views, not copies.
+
+    Args:
+        image (cv2 image): black and white image to process, with black or white text
+        output_folder (str): path to folder in which to save the image of detected columns, does not save if equals None. default=None
+        temp_folder (str): path to folder in which to intermediary images, does not save if equals None. default=None
+        min_gutter (int): minimum width in pixels of the white space between two columns. default=20
+        max_rule (int): maximum width in pixels of a vertical line inside a gutter. default=10
+        verbose (bool): print extra information to console?
+
+    Returns:
+        tuple[list, list, list]: a tuple containing three elements:
+            1. A list of the detected column images (views of image)
+            2. A list of the rectangle coordinates for each column (x, y, w, h)
+            3. A list of the gutters (x1, x2, confidence), where the confidence
+               in [0, 1] is how much emptier the gutter is than its neighbouring columns
+    '''
+    blur = cv2.GaussianBlur(image, (5, 5), 0)
+    thresh = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    if np.count_nonzero(thresh) > thresh.size // 2:
+        # the image was already inverse binary (white text on black), the background is the majority
+        thresh = cv2.bitwise_not(thresh)
+    ink = np.count_nonzero(thresh, axis=0)
+
+    # a column with less than 1% of ink is white space
+    white = ink <= 0.01 * thresh.shape[0]
+    for start, end in get_runs(~white):
+        if end - start <= max_rule and start > 0 and end < white.shape[0]:
+            white[start:end] = True
+
+    width = white.shape[0]
+    gutters = [(start, end) for start, end in get_runs(white) if end - start >= min_gutter and start > 0 and end < width]
+    bounds = [0] + [b for g in gutters for b in g] + [width]
+    spans = [(bounds[i], bounds[i+1]) for i in range(0, len(bounds), 2)]
+
+    if verbose:
+        print(f'found {len(gutters)} gutters, filtering...')
+
+    column_images = []
+    columns = []
+    boxed_image = image.copy() if temp_folder else None
+    for x1, x2 in spans:
+        # trim the page margins and the rules next to the gutters
+        filled = np.flatnonzero(~white[x1:x2])
+        if filled.shape[0] == 0:
+            continue
+        x1, x2 = x1 + filled[0], x1 + filled[-1] + 1
+        rows = np.flatnonzero(np.count_nonzero(thresh[:, x1:x2], axis=1))
+        x, y, w, h = int(x1), int(rows[0]), int(x2 - x1), int(rows[-1] - rows[0] + 1)
+        if h > 200 and w > 150:
+            roi = image[y:y+h, x:x+w]
+            conditional_save(roi, get_conditional_path(f'roi_{len(columns)}.png', output_folder))
+            if temp_folder:
+                cv2.rectangle(boxed_image, (x, y), (x+w, y+h), (36, 255, 12), 2)
+            columns.append((x, y, w, h))
+            column_images.append(roi)
+
+    gutter_confidence = []
+    for i, (x1, x2) in enumerate(gutters):
+        left, right = spans[i], spans[i+1]
+        neighbours = np.concatenate([ink[left[0]:left[1]], ink[right[0]:right[1]]])
+        density = np.mean(neighbours) if neighbours.shape[0] > 0 else 0
+        confidence = 1 - np.mean(ink[x1:x2]) / density if density > 0 else 0
+        gutter_confidence.append((int(x1), int(x2), float(np.clip(confidence, 0, 1))))
+
+    if verbose:
+        print(f'finished filtering, got {len(columns)} columns')
+    
+    conditional_save(boxed_image, get_conditional_path('column_boxes.png', temp_folder))
+    
+    return column_images, columns, gutter_confidence
+
+
+def get_projection_lines(image, min_length: float = 0.5, max_gap: int = 100, scale: float = 0.25) -> np.ndarray:
+    '''Find long horizontal and vertical lines using ink projections.
+
+    A cheaper alternative to cv2.HoughLinesP for page borders: the image is
+    downscaled, only the rows and columns whose ink count could hold a long
+    line are kept, and in each of them the longest run of ink allowing gaps of
+    up to max_gap pixels is taken as a line.
+
+    Args:
+        image (cv2 image): inverse binary image, lines are > 0
+        min_length (float): minimum length of a line, relative to the height (vertical) or width (horizontal) of the image. default=0.5
+        max_gap (int): maximum gap in pixels between connectable line segments. default=100
+        scale (float): scale of the image used to compute the projections. default=0.25
+
+    Returns:
+        np.ndarray: lines in the same format as cv2.HoughLinesP, shape (N, 1, 4) with (x1, y1, x2, y2) in full resolution
+    '''
+    small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) > 0
+    h, w = small.shape
+    gap = max(int(max_gap * scale), 1)
+
+    lines = []
+    for axis, length in ((0, h), (1, w)): # axis 0 projects the columns (vertical lines)
+        counts = small.sum(axis=axis)
+        for i in np.flatnonzero(counts >= min_length * length):
+            ink = np.flatnonzero(small[:, i] if axis == 0 else small[i, :])
+            breaks = np.flatnonzero(np.diff(ink) > gap)
+            starts = np.concatenate([[0], breaks + 1])
+            ends = np.concatenate([breaks, [ink.shape[0] - 1]])
+            k = np.argmax(ink[ends] - ink[starts])
+            start, end = ink[starts[k]], ink[ends[k]]
+            if end - start < min_length * length:
+                continue
+            i, start, end = int(i / scale), int(start / scale), int(end / scale)
+            lines.append((i, start, i, end) if axis == 0 else (start, i, end, i))
+    
+    return np.array(lines, dtype=int).reshape(-1, 1, 4)
+
+
+def crop_margins(image, temp_folder: str = None, output_path: str = None, method: str = 'hough') -> tuple:
     '''Crop image to margins using line detection.
 
     Args:
         image (cv2 image): black and white image to process
         output_path (str): path to write the output image to, does not save if equals None. default=None
         temp_folder (str): folder to write the intermediary files to, does not save if equals None. default=None
+        method (str): line detector, either 'hough' (cv2.HoughLinesP) or 'projection' (get_projection_lines). default='hough'
 
     Returns:
         tuple: image of the main body (cv2 image); crop coordinates
@@ -142,7 +271,10 @@ def crop_margins(image, temp_folder: str = None, output_path: str = None) -> tup
 
     # Run Hough on edge detected image
     # Output "lines" is an array containing endpoints of detected line segments
-    lines = cv2.HoughLinesP(erode, rho, theta, threshold, np.array([]), min_line_length, max_line_gap)
+    if method == 'projection':
+        lines = get_projection_lines(erode, min_length=0.5, max_gap=max_line_gap)
+    else:
+        lines = cv2.HoughLinesP(erode, rho, theta, threshold, np.array([]), min_line_length, max_line_gap)
 
     grouped_lines = ([], [])
     for line in lines:
@@ -189,22 +321,29 @@ def crop_margins(image, temp_folder: str = None, output_path: str = None) -> tup
     
     return content, (x1, x2, y1, y2)
 
-def crop_background(image, temp_folder: str = None, output_path: str = None) -> tuple:
+def crop_background(image, temp_folder: str = None, output_path: str = None, scale: float = 1.0) -> tuple:
     '''Crop image removing background filtering color.
 
     Args:
         image (cv2 image): black and white image to process
         output_path (str): path to write the output image to, does not save if equals None. default=None
         temp_folder (str): folder to write the intermediary files to, does not save if equals None. default=None
+        scale (float): scale of the image used to compute the background mask, e.g. 0.25. default=1.0
 
     Returns:
         tuple: image of the main body (cv2 image); crop coordinates
     
     Remarks:
         reference https://medium.com/featurepreneur/colour-filtering-and-colour-pop-effects-using-opencv-python-3ce7d4576140
+
+        With scale < 1 the closing kernel shrinks with the mask, so the 200x200
+        closing becomes a 50x50 one at 0.25, and the crop coordinates are
+        mapped back to the full resolution image.
     '''
+    small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale != 1.0 else image
+
     # convert the BGR image to HSV colour space
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
 
     lower_bg = (95, 40, 120)
     upper_bg = (115, 90, 240)
@@ -215,30 +354,34 @@ def crop_background(image, temp_folder: str = None, output_path: str = None) ->
     save_to = os.path.join(temp_folder, 'bg_mask.png') if temp_folder else None
     conditional_save(mask, save_to)
 
-    no_noise = remove_noise(mask, kernel_size=(50, 50))
-    save_to = os.path.join(temp_folder, 'bg_mask_no_noise.png') if temp_folder else None
-    conditional_save(no_noise, save_to)
+    if temp_folder:
+        # only used for the intermediary images, the crop starts again from the mask
+        no_noise = remove_noise(mask, kernel_size=(max(int(50 * scale), 1), max(int(50 * scale), 1)))
+        save_to = os.path.join(temp_folder, 'bg_mask_no_noise.png')
+        conditional_save(no_noise, save_to)
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (20,20))
-    no_noise = cv2.dilate(no_noise, kernel, iterations=1)
-    save_to = os.path.join(temp_folder, 'bg_mask_dilate.png') if temp_folder else None
-    conditional_save(no_noise, save_to)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(int(20 * scale), 1), max(int(20 * scale), 1)))
+        no_noise = cv2.dilate(no_noise, kernel, iterations=1)
+        save_to = os.path.join(temp_folder, 'bg_mask_dilate.png')
+        conditional_save(no_noise, save_to)
 
-    no_noise = remove_noise(mask, kernel_size=(200, 200))
+    no_noise = remove_noise(mask, kernel_size=(max(int(200 * scale), 1), max(int(200 * scale), 1)))
     save_to = os.path.join(temp_folder, 'mask_no_noise.png') if temp_folder else None
     conditional_save(no_noise, save_to)
 
     _, no_noise = cv2.threshold(no_noise, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     cnts = cv2.findContours(no_noise, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cnts = cnts[0] if len(cnts) == 2 else cnts[1]
-    cnts = sorted(cnts, key=lambda x: cv2.contourArea(x))
-    cnt = cnts[-1] # select largest
+    cnt = max(cnts, key=cv2.contourArea) # select largest
     x, y, w, h = cv2.boundingRect(cnt)
 
     x1 = x
     x2 = x1+w
     y1 = y
     y2 = y1+h
+    if scale != 1.0:
+        x1, x2 = int(round(x1 / scale)), min(int(round(x2 / scale)), image.shape[1])
+        y1, y2 = int(round(y1 / scale)), min(int(round(y2 / scale)), image.shape[0])
 
     image = image[y1:y2, x1:x2]
     conditional_save(image, output_path)
@@ -246,19 +389,21 @@ def crop_background(image, temp_folder: str = None, output_path: str = None) ->
     return image, (x1, x2, y1, y2)
 
 
-def crop_to_page(image, temp_folder: str = None, output_path: str = None) -> tuple:
+def crop_to_page(image, temp_folder: str = None, output_path: str = None, method: str = 'hough') -> tuple:
     '''Crop image to focus only on target page.
 
     Args:
         image (cv2 image): black and white image to process
         output_path (str): path to write the output image to, does not save if equals None. default=None
         temp_folder (str): folder to write the intermediary files to, does not save if equals None. default=None
+        method (str): line detector, either 'hough' (cv2.HoughLinesP) or 'projection' (get_projection_lines). default='hough'
 
     Returns:
         tuple: image of the main body (cv2 image); crop coordinates
     '''
     _, thresh = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
-    blur = cv2.medianBlur(thresh, 13)
+    # the projection tolerates the text between the gaps, so it does not need the median blur
+    blur = cv2.medianBlur(thresh, 13) if method == 'hough' else thresh
     conditional_save(blur, get_conditional_path('median_blur.png', temp_folder))
     
     rho = 1  # distance resolution in pixels of the Hough grid
@@ -270,7 +415,10 @@ def crop_to_page(image, temp_folder: str = None, output_path: str = None) -> tup
 
     # Run Hough on edge detected image
     # Output "lines" is an array containing endpoints of detected line segments
-    lines = cv2.HoughLinesP(blur, rho, theta, threshold, np.array([]), min_line_length, max_line_gap)
+    if method == 'projection':
+        lines = get_projection_lines(blur, min_length=0.5, max_gap=max_line_gap)
+    else:
+        lines = cv2.HoughLinesP(blur, rho, theta, threshold, np.array([]), min_line_length, max_line_gap)
 
     xs, ys = [], [] # list of x and y for long lines
     for line in lines:
@@ -287,25 +435,38 @@ def crop_to_page(image, temp_folder: str = None, output_path: str = None) -> tup
     top = int(np.median([y for y in ys if y < thresh.shape[0] * 0.2])) if len(ys) > 0 else 0
     bottom = int(np.median([y for y in ys if y > thresh.shape[0] * 0.8])) if len(ys) > 0 else thresh.shape[0]
     
-    cv2.rectangle(line_image, (left,top), (right,bottom), 128, 2)
-    conditional_save(line_image, get_conditional_path('lines_rect.png', temp_folder))
+    if temp_folder:
+        # the writer may still hold line_image for lines.png, draw on a copy
+        rect_image = line_image.copy()
+        cv2.rectangle(rect_image, (left,top), (right,bottom), 128, 2)
+        conditional_save(rect_image, get_conditional_path('lines_rect.png', temp_folder))
     
     cropped = image[top:bottom, left:right]
     conditional_save(cropped, output_path)
     
     return cropped, (left, right, top, bottom)
 
-def extract_page(image, temp_folder: str = None, output_path: str = None) -> tuple:
-    '''Extract the page based on (Chandrasekar, 2020).
+def find_book(image, temp_folder: str = None, scale: float = 1.0) -> 'tuple[np.ndarray, tuple[int, int, int, int], np.ndarray]':
+    '''Find the book in a scan based on (Chandrasekar, 2020).
 
     Args:
         image (cv2 image): colored image to process
-        output_path (str): path to write the output image to, does not save if equals None. default=None
         temp_folder (str): folder to write the intermediary files to, does not save if equals None. default=None
+        scale (float): scale of the image used to detect the page and the hinge, e.g. 0.25. default=1.0
 
     Returns:
-        tuple: image of the main body (cv2 image); crop coordinates
+        tuple: transform from the image to the book (3x3 np.ndarray), crop
+        coordinates (left, right, top, bottom) and the columns of the
+        saturation peaks found between left and right, relative to left
+    
+    Remarks:
+        The detection runs on a downscaled copy when scale < 1, the transform
+        and coordinates found are then mapped back to the full resolution.
     '''
+    from scipy.signal import find_peaks
+
+    if scale != 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
     ### Book Extraction
     #convert the BGR image to HSV colour space
@@ -324,20 +485,20 @@ def extract_page(image, temp_folder: str = None, output_path: str = None) -> tup
     cnt = cnts[-1] # select largest
 
     #### Straighten the image
+    # the rotation and the crops are accumulated in a single transform, only
+    # the small saturation channel is resampled for the hinge detection and
+    # the colored image is resampled once at the end
     angle = get_contour_angle(cnt)
-    image = rotate_image(image, -angle)
-    hsv = rotate_image(hsv, -angle)
-    mask = rotate_image(mask, -angle)
-
-    cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = cnts[0] if len(cnts) == 2 else cnts[1]
-    cnts = sorted(cnts, key=lambda x: cv2.contourArea(x))
-    cnt = cnts[-1] # select largest
+    M = get_rotation_matrix(image.shape, -angle)
 
-    x, y, w, h = cv2.boundingRect(cnt)
+    x, y, w, h = cv2.boundingRect(transform_points(cnt, M))
+    # the part of the box above or left of the image is cut from its size too
+    w, h = w + min(x, 0), h + min(y, 0)
+    x, y = max(x, 0), max(y, 0)
+    w, h = min(w, image.shape[1] - x), min(h, image.shape[0] - y)
+    M = get_translation_matrix(-x, -y) @ M
 
-    img = image[y:y+h, x:x+w]
-    hsv = hsv[y:y+h, x:x+w]
+    hsv = apply_transform(hsv, M, (w, h), interpolation=cv2.INTER_LINEAR)
     
     ### Hinge Detection
     s = hsv[:,:,1]
@@ -346,9 +507,10 @@ def extract_page(image, temp_folder: str = None, output_path: str = None) -> tup
     idx, _ = find_peaks(sat_mean, prominence=10)
     left, right = np.min(idx), np.max(idx)
     
-    img = img[:, left:right]
     hsv = hsv[:, left:right]
-    conditional_save(img, get_conditional_path('after_hinge.png', temp_folder))
+    if temp_folder:
+        # from the straightened detection image, the scan is only resampled by the caller
+        conditional_save(cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR), get_conditional_path('after_hinge.png', temp_folder))
     
     ### Page Detection (altered)
     #create the mask over the new image
@@ -359,6 +521,61 @@ def extract_page(image, temp_folder: str = None, output_path: str = None) -> tup
     is_page = np.argwhere(is_page.sum(axis=1) > 0.3 * mask.shape[0]).flatten()
     top, bottom = np.min(is_page), np.max(is_page)
 
-    conditional_save(img[top:bottom,:], output_path)
+    M = get_translation_matrix(-left, -top) @ M
+    peaks = idx[(idx > left) & (idx < right)] - left
+    if scale != 1.0:
+        # same transform expressed in full resolution coordinates
+        M = get_scale_matrix(1 / scale) @ M @ get_scale_matrix(scale)
+        left, right, top, bottom = [int(round(c / scale)) for c in (left, right, top, bottom)]
+        peaks = np.round(peaks / scale).astype(int)
+    return M, (left, right, top, bottom), peaks
+
+
+def extract_page(image, temp_folder: str = None, output_path: str = None, scale: float = 1.0) -> tuple:
+    '''Extract the page based on (Chandrasekar, 2020).
+
+    Args:
+        image (cv2 image): colored image to process
+        output_path (str): path to write the output image to, does not save if equals None. default=None
+        temp_folder (str): folder to write the intermediary files to, does not save if equals None. default=None
+        scale (float): scale of the image used to detect the page and the hinge, e.g. 0.25. default=1.0
+
+    Returns:
+        tuple: image of the main body (cv2 image); crop coordinates
+    
+    Remarks:
+        The detection runs on a downscaled copy when scale < 1, the transform
+        found is then mapped back and applied to the full resolution image.
+    '''
+    M, (left, right, top, bottom), _ = find_book(image, temp_folder, scale)
+    img = apply_transform(image, M, (right - left, bottom - top))
+    conditional_save(img, output_path)
     
-    return img[top:bottom,:], (left, right, top, bottom)
+    return img, (left, right, top, bottom)
+
+
+def extract_pages(image, temp_folder: str = None, scale: float = 1.0) -> 'list[tuple]':
+    '''Extract both pages of a two page spread.
+
+    The book is detected and straightened once, as in extract_page, and split
+    at the gutter, the saturation peak closest to the middle of the book. If
+    there is no peak in the middle third, the book is split in half.
+
+    Args:
+        image (cv2 image): colored image of the spread
+        temp_folder (str): folder to write the intermediary files to, does not save if equals None. default=None
+        scale (float): scale of the image used to detect the book and the gutter, e.g. 0.25. default=1.0
+
+    Returns:
+        list[tuple]: image of each page (cv2 image, a view of the straightened
+        book) and its crop coordinates (left, right, top, bottom)
+    '''
+    M, (left, right, top, bottom), peaks = find_book(image, temp_folder, scale)
+    book = apply_transform(image, M, (right - left, bottom - top))
+    conditional_save(book, get_conditional_path('book.png', temp_folder))
+
+    width = right - left
+    middle = peaks[(peaks > width / 3) & (peaks < 2 * width / 3)]
+    gutter = int(middle[np.argmin(np.abs(middle - width / 2))]) if len(middle) > 0 else width // 2
+
+    return [(book[:, :gutter], (left, left + gutter, top, bottom)), (book[:, gutter:], (left + gutter, right, top, bottom))]
@@ -0,0 +1,208 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    edition TEXT NOT NULL,
+    page TEXT NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    enqueued_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    seconds REAL,
+    report TEXT,
+    error TEXT,
+    UNIQUE (edition, page)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+'''
+
+def get_worker_name() -> str:
+    '''Name a worker process after its host and pid.'''
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    '''Durable queue of pages stored in a SQLite file.
+
+    Any number of processes, on any number of hosts sharing the file, can
+    drain the same queue: a job is leased by a single worker for lease_seconds
+    and is given to another worker only if the lease expires before it is
+    completed. Failed jobs go back to the queue until they were attempted
+    max_attempts times. The default rollback journal is used instead of WAL,
+    since WAL does not work on network filesystems.
+
+    Args:
+        path (str): path to the SQLite file, created if it does not exist
+        lease_seconds (float): time a worker has to finish a job before it is given to another. default=3600
+        max_attempts (int): number of times a job is tried before it is marked as failed. default=3
+    '''
+    def __init__(self, path: str, lease_seconds: float = 3600, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self, mode: str = 'DEFERRED'):
+        '''Run the statements of the block in a single transaction.
+
+        Args:
+            mode (str): DEFERRED, or IMMEDIATE to take the write lock before reading. default='DEFERRED'
+        '''
+        self.connection.execute(f'BEGIN {mode}')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def enqueue(self, jobs: 'list[tuple[str, str, str]]') -> int:
+        '''Add pages to the queue, ignoring the ones already in it.
+
+        Args:
+            jobs (list[tuple[str, str, str]]): edition name, page name and image path of each page
+
+        Returns:
+            int: number of pages added
+        '''
+        now = time.time()
+        with self.transaction():
+            before = self.connection.total_changes
+            self.connection.executemany('INSERT OR IGNORE INTO jobs (edition, page, path, enqueued_at) VALUES (?, ?, ?, ?)',
+                                        [(ed, page, path, now) for ed, page, path in jobs])
+            return self.connection.total_changes - before
+
+    def lease(self, worker: str = None) -> tuple:
+        '''Take the next pending job, or a job whose lease expired.
+
+        Args:
+            worker (str): name of the worker, defaults to host:pid
+
+        Returns:
+            tuple: id, edition name, page name and image path of the job, None if there are no jobs left
+        '''
+        worker = worker or get_worker_name()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock before reading, so two workers can not lease the same job
+        with self.transaction('IMMEDIATE') as connection:
+            connection.execute("UPDATE jobs SET status = 'failed', error = 'lease expired' WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                               (now, self.max_attempts))
+            row = connection.execute("SELECT id, edition, page, path FROM jobs WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+                                     (now,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, started_at = ? WHERE id = ?",
+                                   (worker, now + self.lease_seconds, now, row[0]))
+        return row
+
+    def renew(self, job_id: int, worker: str = None) -> bool:
+        '''Extend the lease of a job that is taking long.
+
+        Args:
+            job_id (int): id of the job
+            worker (str): name of the worker that leased it, defaults to host:pid
+
+        Returns:
+            bool: False if the job is no longer leased by the worker
+        '''
+        return self.connection.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                                       (time.time() + self.lease_seconds, job_id, worker or get_worker_name())).rowcount > 0
+
+    @contextmanager
+    def heartbeat(self, job_id: int, worker: str = None, interval: float = None):
+        '''Renew the lease of a job from a background thread while the block runs.
+
+        Args:
+            job_id (int): id of the job
+            worker (str): name of the worker that leased it, defaults to host:pid
+            interval (float): seconds between renewals. default=a third of lease_seconds
+        '''
+        worker = worker or get_worker_name()
+        stopped = threading.Event()
+
+        def renew():
+            jobs = JobQueue(self.path, self.lease_seconds, self.max_attempts) # connections can not be shared between threads
+            try:
+                while not stopped.wait(interval or self.lease_seconds / 3):
+                    if not jobs.renew(job_id, worker):
+                        break
+            finally:
+                jobs.close()
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, job_id: int, report: dict = None, worker: str = None) -> bool:
+        '''Mark a job as done.
+
+        Args:
+            job_id (int): id of the job
+            report (dict): time and memory measurements of the page, see StageTracker.report. default=None
+            worker (str): name of the worker that leased it, defaults to host:pid
+
+        Returns:
+            bool: False if the lease expired and the job was given to another worker
+        '''
+        now = time.time()
+        return self.connection.execute("UPDATE jobs SET status = 'done', finished_at = ?, seconds = ? - started_at, report = ?, error = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+                                       (now, now, json.dumps(report) if report else None, job_id, worker or get_worker_name())).rowcount > 0
+
+    def fail(self, job_id: int, error: str, worker: str = None) -> bool:
+        '''Put a job back in the queue, or mark it as failed if it reached max_attempts.
+
+        Returns:
+            bool: False if the lease expired and the job was given to another worker
+        '''
+        return self.connection.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, finished_at = ?, error = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                                       (self.max_attempts, time.time(), error, job_id, worker or get_worker_name())).rowcount > 0
+
+    def counts(self) -> dict:
+        '''Count the jobs in each status.'''
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def reset(self, status: str = 'failed') -> int:
+        '''Put every job in a status back in the queue with no attempts.
+
+        Returns:
+            int: number of jobs put back
+        '''
+        return self.connection.execute("UPDATE jobs SET status = 'pending', attempts = 0, error = NULL WHERE status = ?", (status,)).rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Inspect a page queue.')
+    parser.add_argument('--retry', action='store_true', help='put the failed pages back in the queue.')
+    parser.add_argument('--failed', action='store_true', help='list the failed pages and their errors.')
+    parser.add_argument('queue', help='path to the queue file')
+    args = parser.parse_args()
+
+    jobs = JobQueue(args.queue)
+    if args.retry:
+        print(f'{jobs.reset()} pages put back in the queue')
+    for status, count in sorted(jobs.counts().items()):
+        print(f'{status}\t{count}')
+    if args.failed:
+        for edition, page, error in jobs.connection.execute("SELECT edition, page, error FROM jobs WHERE status = 'failed' ORDER BY id"):
+            print(f'{edition}\t{page}\t{error}')
+    jobs.close()
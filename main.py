@@ -1,95 +1,611 @@
 import glob
 import os
+import shutil
 import cv2
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from unidecode import unidecode
 from tqdm import tqdm
 
 from process_pdfs import convert_pdfs
-from image_prep import deskew, prepare_image, remove_noise
-from image_processing import extract_page
+from image_prep import deskew, grayscale, prepare_image, remove_noise
+from image_processing import detect_columns_projection, extract_page, extract_pages
+from atlas import ocr_regions
+from dedup import MAX_DISTANCE, HashIndex, phash, thumbnail
+from edition_store import EditionStore, get_store_path, get_words
+from job_queue import JobQueue
+from text_index import TextIndex
+from metrics import PipelineMetrics, serve_metrics
 from mhs_layout_analisys import segment
+from page_io import AsyncWriter, PageReader
+from triage import triage_page, triage_region, write_triage_log
+from profiling import Deadline, DeadlineExceeded, StageTracker, estimate_workers, trace_memory, format_size, merge_reports, parse_size, peak_rss, read_footprint, write_memory_log
 import utils
 
-parser = argparse.ArgumentParser(description='Reconhece jornais históricos Correio da Lavoura.')
-parser.add_argument('--production', '-p', action='store_true', help='flag if is running in productive environment')
-parser.add_argument('--pdf', action='store_true', help='flag if the input is one or more pdf files.')
-parser.add_argument('--mhs', action='store_true', help='flag to use mhs segmentation before running tesseract.')
-parser.add_argument('--verbose', '-v', action='store_true', help='print information messages to console.')
-parser.add_argument('--edition', '-e', type=str, help='only run on the specified edition name')
-parser.add_argument('--output', '-o', type=str, help='directory to store the output in')
-parser.add_argument('input', nargs='*', type=str, help='input files. if flag --pdf is used, files must be PDFs, otherwise PNGs are expected.')
-args = parser.parse_args()
-
-PROCESS_PDFS = args.pdf
 DO_OCR = True
 OCR_BASE = DO_OCR and False
 OCR_GRAY = DO_OCR and False
 OCR_PROCESSED = DO_OCR and True
 REMOVE_NOISE = False
-DO_MHS = args.mhs
-VERBOSE = args.verbose
+OCR_VARIANTS = ['proc', 'gray', 'base'] # processed page, grayscale cropped page and unprocessed page
 
-def log(msg):
-    if VERBOSE:
+def parse_variants(text: str) -> 'list[str]':
+    variants = text.split(',')
+    unknown = [v for v in variants if v not in OCR_VARIANTS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown OCR variants {", ".join(unknown)}, use {", ".join(OCR_VARIANTS)}')
+    return variants
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Reconhece jornais históricos Correio da Lavoura.')
+    parser.add_argument('--production', '-p', action='store_true', help='flag if is running in productive environment')
+    parser.add_argument('--pdf', action='store_true', help='flag if the input is one or more pdf files.')
+    parser.add_argument('--extract-images', action='store_true', help='with --pdf, save the scanned image of each page as it is embedded in the PDF instead of rendering the page. needs PyMuPDF.')
+    parser.add_argument('--mhs', action='store_true', help='flag to use mhs segmentation before running tesseract.')
+    parser.add_argument('--mhs-scale', type=float, default=1.0, help='scale in which mhs finds the region layout, e.g. 0.25. default=1')
+    parser.add_argument('--mhs-packed', action='store_true', help='run mhs on a bit-packed binary page, using 8 times less memory.')
+    parser.add_argument('--page-timeout', type=float, help='seconds a page may spend, checked between the stages and within mhs. a page past it is processed without mhs, deskewed in a single pass and only read as the processed page, without --columns or the other variants. no limit by default.')
+    parser.add_argument('--stage-timeout', type=float, help='seconds mhs may spend on a page before it is processed without mhs instead, e.g. 120. no limit by default.')
+    parser.add_argument('--max-regions', type=int, help='number of regions mhs may split a page into before it is processed without mhs instead, e.g. 2000 for halftone pictures. no limit by default.')
+    parser.add_argument('--atlas', action='store_true', help='with --mhs, pack the text regions onto a few large images and run tesseract once per image instead of on the whole page, keeping the words of each region apart.')
+    parser.add_argument('--columns', action='store_true', help='run tesseract on each column detected by the gutters between them instead of on the whole page.')
+    parser.add_argument('--race-variants', type=parse_variants, help='comma separated OCR variants to run at the same time, keeping the most confident in best.txt, e.g. proc,gray,base. replaces the OCR constants.')
+    parser.add_argument('--min-confidence', type=float, help='with --race-variants, stop the other variants once one reaches this mean confidence, e.g. 80. waits for all of them by default.')
+    parser.add_argument('--triage', action='store_true', help='skip blank and picture pages, run mhs only on pages that mix text and non-text elements, and drop mhs regions with no text. the decisions are logged to --triage-log.')
+    parser.add_argument('--triage-log', type=str, default='./temp/triage.tsv', help='file to log the triage decisions in. default=./temp/triage.tsv')
+    parser.add_argument('--dedup', type=str, help='SQLite file with a perceptual hash and a thumbnail of each cropped page. a page that looks like one already processed, e.g. a rescan, is logged and recorded as its duplicate. see dedup.py for a report of the duplicates.')
+    parser.add_argument('--dedup-distance', type=int, default=MAX_DISTANCE, help=f'number of different bits, out of 64, up to which two page hashes are candidate duplicates, confirmed by their thumbnails. default={MAX_DISTANCE}')
+    parser.add_argument('--dedup-reuse', action='store_true', help='with --dedup, give a duplicate page a copy of the texts of the page it duplicates instead of processing it.')
+    parser.add_argument('--verbose', '-v', action='store_true', help='print information messages to console.')
+    parser.add_argument('--spread', action='store_true', help='flag if each scan is a two page spread. the scan is read and straightened once, split at the gutter and both pages are processed in parallel.')
+    parser.add_argument('--detection-scale', type=float, default=1.0, help='scale of the image used to detect the page before cropping, e.g. 0.25. default=1')
+    parser.add_argument('--tile-size', type=int, help='run the image filters in parallel tiles of this size, e.g. 1024. does not tile by default.')
+    parser.add_argument('--prefetch', type=int, default=2, help='number of pages to decode ahead in a background thread, 0 to disable. default=2')
+    parser.add_argument('--write-queue', type=int, default=16, help='number of pending image and text writes handled by a background thread, 0 to disable. default=16')
+    parser.add_argument('--intermediate-format', choices=['png', 'npy'], default='png', help='format of the cropped, prepared and final page images in ./temp. npy files are raw arrays that later stages and reruns map into memory without decoding. default=png')
+    parser.add_argument('--reuse-intermediates', action='store_true', help='start from the cropped page saved in ./temp by a previous run, if it exists, instead of loading and cropping the page again.')
+    parser.add_argument('--memory-report', action='store_true', help='measure the peak memory of each page and stage and append it to the memory log.')
+    parser.add_argument('--memory-budget', type=str, help='memory available to the run, e.g. 8G. pages are processed concurrently in as many processes as fit in the budget. without measurements in the memory log, the memory of the first page is measured to size them.')
+    parser.add_argument('--memory-log', type=str, default='./temp/memory.tsv', help='file to store the memory measurements in. default=./temp/memory.tsv')
+    parser.add_argument('--queue', type=str, help='SQLite file shared by the workers, e.g. on a network drive. the input pages are added to it and this process takes pages from it until none are left, so several processes and hosts can split the work.')
+    parser.add_argument('--lease', type=float, default=3600, help='seconds a worker has to finish a page of the queue before it is given to another. default=3600')
+    parser.add_argument('--max-attempts', type=int, default=3, help='number of times a page of the queue is tried before it is marked as failed. default=3')
+    parser.add_argument('--index', type=str, help='SQLite full text index to add each page to once its text is recognized, see text_index.py to query it.')
+    parser.add_argument('--store', type=str, help='folder to keep one SQLite file per edition in, with the text, confidence and word boxes of each page, instead of writing text files to the output folder. see edition_store.py to export them.')
+    parser.add_argument('--thumbnails', action='store_true', help='with --store, also keep a small JPEG of each processed page.')
+    parser.add_argument('--metrics-file', type=str, help='file to rewrite with the throughput, stage latency and error metrics after each page, in the Prometheus text format, e.g. for the textfile collector of the node exporter.')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics on http://127.0.0.1:<port>/metrics while the run lasts.')
+    parser.add_argument('--edition', '-e', type=str, help='only run on the specified edition name')
+    parser.add_argument('--output', '-o', type=str, help='directory to store the output in')
+    parser.add_argument('input', nargs='*', type=str, help='input files. if flag --pdf is used, files must be PDFs, otherwise PNGs or JPGs are expected.')
+    return parser
+
+def log(msg, verbose: bool = True):
+    if verbose:
         print(msg)
 
-input_files = []
-for input_file in args.input:
-    input_files.extend(glob.glob(input_file))
+def index_page(args: argparse.Namespace, ed_name: str, page_name: str, text: str, text_path: str = None):
+    '''Replace the text of a page in the full text index, if there is one.
+
+    The modification time of text_path is stored with the page, so text_index.py build skips it.
+    '''
+    if not args.index:
+        return
+    modified = None
+    if text_path:
+        if utils.WRITER is not None:
+            utils.WRITER.flush() # the text file may still be queued
+        if os.path.exists(text_path):
+            modified = os.path.getmtime(text_path)
+    index = TextIndex(args.index)
+    index.add_page(ed_name, page_name, text, modified)
+    index.close()
+
+def over_budget(deadline: Deadline, tracker: StageTracker, ed_name: str, page_name: str) -> bool:
+    '''Check if a page is past its deadline after mhs, marking it as degraded the first time.
+
+    A degraded page is deskewed in a single pass and only its processed
+    variant is read, without the columns, to bound the time of the slow pages.
+    '''
+    if tracker.outcome == 'degraded':
+        return True
+    if not deadline.expired():
+        return False
+    tracker.outcome = 'degraded'
+    log(f'DEGRADED page "{page_name}" from "{ed_name}": past its deadline of {deadline.seconds:g} seconds, running the cheaper stages', True)
+    return True
+
+def get_text_path(args: argparse.Namespace, output_path: str, name: str) -> str:
+    '''Get the path of a text file of a page, None if the texts go to the edition store.'''
+    return None if args.store else os.path.join(output_path, name)
+
+def store_page(args: argparse.Namespace, ed_name: str, page_name: str, variant: str, text: str, conf: float, data=None, image=None):
+    '''Keep the text of a page in the store of its edition, if there is one.'''
+    if not args.store:
+        return
+    store = EditionStore(get_store_path(args.store, ed_name))
+    store.put_text(page_name, text, conf, None if data is None else get_words(data), variant)
+    if args.thumbnails and image is not None:
+        store.put_thumbnail(page_name, image)
+    store.close()
+
+def find_duplicate(args: argparse.Namespace, ed_name: str, page_name: str, page_hash: int, page_thumb) -> 'tuple[str, str, int]':
+    '''Find an already processed page that looks like a page, see HashIndex.find.'''
+    hashes = HashIndex(args.dedup)
+    duplicate = hashes.find(ed_name, page_name, page_hash, page_thumb, args.dedup_distance)
+    hashes.close()
+    return duplicate
+
+def record_hash(args: argparse.Namespace, ed_name: str, page_name: str, page_hash: int, page_thumb=None, duplicate_of: 'tuple[str, str]' = None):
+    '''Add a processed page to the hash index, if there is one.'''
+    if page_hash is None:
+        return
+    hashes = HashIndex(args.dedup)
+    hashes.add(ed_name, page_name, page_hash, page_thumb, duplicate_of)
+    hashes.close()
+
+def reuse_page(args: argparse.Namespace, ed_name: str, page_name: str, output_path: str, src_ed: str, src_page: str) -> str:
+    '''Copy the texts of an already processed page to a page that duplicates it.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+        ed_name (str): name of the edition of the duplicate
+        page_name (str): name of the duplicate
+        output_path (str): output folder of the duplicate
+        src_ed (str): name of the edition of the processed page
+        src_page (str): name of the processed page
+
+    Returns:
+        str: text of the processed page, None if it has no texts to copy
+    '''
+    if utils.WRITER is not None:
+        utils.WRITER.flush() # the texts of the processed page may still be queued
+    texts = {}
+    if args.store:
+        source = EditionStore(get_store_path(args.store, src_ed))
+        for variant in OCR_VARIANTS + ['best']:
+            texts[variant] = source.get_text(src_page, variant)
+        source.close()
+        texts = { variant: t for variant, t in texts.items() if t is not None }
+        if len(texts) > 0:
+            store = EditionStore(get_store_path(args.store, ed_name))
+            for variant, (text, conf, words) in texts.items():
+                store.put_text(page_name, text, conf, words, variant)
+            store.close()
+    else:
+        src_path = os.path.join(args.output, src_page) if args.output else f'./output/{src_ed}/{src_page}'
+        for path in glob.glob(os.path.join(src_path, '*.txt')):
+            shutil.copyfile(path, os.path.join(output_path, os.path.basename(path)))
+            with open(path, encoding='utf-8') as f:
+                texts[utils.get_name(path)] = (f.read(),)
+    for variant in ['proc', 'best'] + OCR_VARIANTS:
+        if variant in texts:
+            return texts[variant][0]
+    return None
 
-os.makedirs('./input/processed', exist_ok=True)
-if PROCESS_PDFS:
-    log('converting PDFs into PNGs')
-    convert_pdfs(input_files, './input/processed', VERBOSE, is_dev=not args.production)
+def process_page(args: argparse.Namespace, ed_name: str, page_name: str, page: str, image=None, cropped: bool = False, spread: bool = False) -> dict:
+    '''Run the whole pipeline on a single page.
 
-all_files = []
+    Args:
+        args (argparse.Namespace): command line arguments
+        ed_name (str): name of the edition
+        page_name (str): name of the page
+        page (str): path to the page image
+        image (cv2 image): the page image if it was already loaded, otherwise it is read from page. default=None
+        cropped (bool): flag if image was already extracted from the scan, e.g. by extract_pages. default=False
+        spread (bool): flag if the page is half of a spread, see process_spread. Its unprocessed
+            variant is then the extracted half instead of the whole scan. default=False
 
-editions = [f'./input/processed/{args.edition}'] if args.edition else glob.glob('./input/processed/*')
-for ed in editions:
-    ed_name = unidecode(utils.get_name(ed, 0).lower())
-    pages = glob.glob(f'{ed}/*.png')
-    for page in pages:
-        page_name = utils.get_name(page)
-        all_files.append((ed_name, page_name, page))
+    Returns:
+        dict: time and memory measurements of the page, see StageTracker.report
+    '''
+    verbose = args.verbose
+    do_mhs = args.mhs
+    tracker = StageTracker(track_memory=args.memory_report)
+    deadline = Deadline(args.page_timeout)
 
-for ed_name, page_name, page in tqdm(all_files):
-    log(f'...in page "{page_name}" from "{ed_name}"')
-    image = utils.load_image(page)
+    fmt = args.intermediate_format
+    log(f'...in page "{page_name}" from "{ed_name}"', verbose)
 
     output_path = os.path.join(args.output, page_name) if args.output else f'./output/{ed_name}/{page_name}'
-    
+
     os.makedirs(f'./temp/{ed_name}/{page_name}', exist_ok=True)
-    os.makedirs(output_path, exist_ok=True)
+    if not args.store:
+        os.makedirs(output_path, exist_ok=True)
+
+    cropped_path = utils.get_intermediate_path(f'./temp/{ed_name}/{page_name}/cropped.png', fmt)
+    if cropped:
+        utils.save_intermediate(image, cropped_path, fmt)
+    elif args.reuse_intermediates and os.path.exists(cropped_path):
+        log('reusing the cropped image', verbose)
+        with tracker.stage('load_image'):
+            image = utils.load_intermediate(cropped_path)
+    else:
+        if image is None:
+            with tracker.stage('load_image'):
+                image = utils.load_image(page)
+
+        log('cropping image', verbose)
+        with tracker.stage('extract_page'):
+            image, _ = extract_page(image, f'./temp/{ed_name}/{page_name}/', scale=args.detection_scale)
+        utils.save_intermediate(image, cropped_path, fmt)
+
+    cropped = image
+    base = cropped if spread else page # the scan of a spread holds both pages
 
-    log('cropping image')
-    image, _ = extract_page(image, f'./temp/{ed_name}/{page_name}/', f'./temp/{ed_name}/{page_name}/cropped.png')
+    page_hash, page_thumb, duplicate_of = None, None, None
+    if args.dedup:
+        with tracker.stage('dedup'):
+            page_hash = phash(image)
+            page_thumb = thumbnail(image)
+            duplicate = find_duplicate(args, ed_name, page_name, page_hash, page_thumb)
+        if duplicate is not None:
+            src_ed, src_page, distance = duplicate
+            duplicate_of = (src_ed, src_page)
+            log(f'page "{page_name}" from "{ed_name}" duplicates page "{src_page}" from "{src_ed}", {distance} bits apart', verbose)
+            text = reuse_page(args, ed_name, page_name, output_path, src_ed, src_page) if args.dedup_reuse else None
+            if text is not None:
+                index_page(args, ed_name, page_name, text, get_text_path(args, output_path, 'proc.txt'))
+                record_hash(args, ed_name, page_name, page_hash, page_thumb, duplicate_of)
+                tracker.outcome = 'reused'
+                log(f'REUSED page "{src_page}" from "{src_ed}" for page "{page_name}" from "{ed_name}"', verbose)
+                return tracker.report()
 
-    log('preparing image')
-    image = prepare_image(image, f'./temp/{ed_name}/{page_name}/prepared.png', f'./temp/{ed_name}/{page_name}', denoise=REMOVE_NOISE, verbose=VERBOSE)
+    log('preparing image', verbose)
+    # the page is rotated for MHS only once it is known to run, see below.
+    # without MHS both deskew passes are accumulated into a single rotation
+    with tracker.stage('prepare_image'):
+        image = prepare_image(image, None, f'./temp/{ed_name}/{page_name}', rotate=False, denoise=REMOVE_NOISE, verbose=verbose, tile_size=args.tile_size)
+    utils.save_intermediate(image, f'./temp/{ed_name}/{page_name}/prepared.png', fmt)
 
+    if args.triage:
+        with tracker.stage('triage'):
+            decision, reason, stats = triage_page(image)
+        write_triage_log(args.triage_log, ed_name, page_name, 'page', decision, reason, stats)
+        log(f'triage chose "{decision}": {reason}', verbose)
+        if decision == 'skip':
+            index_page(args, ed_name, page_name, '')
+            tracker.outcome = 'skipped'
+            log(f'SKIPPED page "{page_name}" from "{ed_name}"', verbose)
+            return tracker.report()
+        do_mhs = decision == 'full'
 
-    if DO_MHS:
-        image, _, _ = segment(image, f'./temp/{ed_name}/{page_name}/')
-        image = deskew(image)
-        image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    if do_mhs:
+        unrotated = image # the fallback deskews this one, rotating the page only once
+        try:
+            deadline.check() # the page may already be out of time, e.g. after a slow extraction
+            with tracker.stage('rotate'):
+                image = deskew(image, tile_size=args.tile_size)
+            utils.conditional_save(image, f'./temp/{ed_name}/{page_name}/rotate.png')
+            deadline.check()
+            with tracker.stage('segment'):
+                segmented, regions, coords = segment(image, f'./temp/{ed_name}/{page_name}/', scale=args.mhs_scale, packed=args.mhs_packed,
+                                                     deadline=deadline.limit(args.stage_timeout, 'segment'), max_regions=args.max_regions)
+            image = segmented
+        except DeadlineExceeded as e:
+            # fall back to the page without segmentation, the usual path without --mhs
+            log(f'FALLBACK without mhs for page "{page_name}" from "{ed_name}": {e}', True)
+            tracker.outcome = 'fallback'
+            image = unrotated
+            do_mhs = False
+
+    if do_mhs:
+        if args.triage:
+            with tracker.stage('triage_regions'):
+                kept = []
+                for i, (region, (x, y, w, h)) in enumerate(zip(regions, coords)):
+                    decision, reason, stats = triage_region(region)
+                    write_triage_log(args.triage_log, ed_name, page_name, str(i), decision, reason, stats)
+                    if decision == 'skip':
+                        if image is segmented:
+                            image = segmented.copy() # segment queued it to the writer as multi_layer.png
+                        image[y:y+h, x:x+w] = 0
+                    else:
+                        kept.append((x, y, w, h))
+                coords = kept
+        with tracker.stage('deskew'):
+            image = deskew(image, tile_size=args.tile_size)
+            image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
         utils.conditional_save(image, f'./temp/{ed_name}/{page_name}/rotated_after_mhs.png')
-        utils.conditional_save(image, f'./temp/{ed_name}/{page_name}.png')
     else:
-        image = deskew(image)
-        utils.conditional_save(image, f'./temp/{ed_name}/{page_name}.png')
+        with tracker.stage('deskew'):
+            image = deskew(image, passes=1 if over_budget(deadline, tracker, ed_name, page_name) else 2, tile_size=args.tile_size)
+    utils.save_intermediate(image, f'./temp/{ed_name}/{page_name}.png', fmt)
+    degraded = over_budget(deadline, tracker, ed_name, page_name)
+
+    if args.race_variants:
+        log('running OCR variants', verbose)
+        sources = { 'proc': lambda: image, 'gray': lambda: grayscale(cropped), 'base': lambda: base }
+        names = args.race_variants
+        if degraded:
+            names = [n for n in names if n == 'proc'] or names[:1]
+        variants = { name: sources[name]() for name in names }
+        with tracker.stage('run_ocr'):
+            name, text, conf = utils.race_ocr(variants, get_text_path(args, output_path, 'best.txt'), args.min_confidence, verbose=verbose)
+        if name is None:
+            raise RuntimeError('every OCR variant failed') # the page fails instead of getting an empty text
+        log(f'best variant is "{name}" with mean confidence {conf:.1f}', verbose)
+        store_page(args, ed_name, page_name, 'best', text, conf, image=image)
+        index_page(args, ed_name, page_name, text, get_text_path(args, output_path, 'best.txt'))
+        record_hash(args, ed_name, page_name, page_hash, page_thumb, duplicate_of)
+        log(f'DONE with page "{page_name}" from "{ed_name}"', verbose)
+        return tracker.report()
 
-    if OCR_BASE:
-        log('running OCR on the unprocessed page')
-        utils.run_ocr(page, os.path.join(output_path, 'base.txt'), f'./temp/{ed_name}/{page_name}/tess_unproc.png', verbose=VERBOSE)
+    extra_ocr = not (degraded and OCR_PROCESSED) # past the deadline, only the processed page is read
+    if OCR_BASE and extra_ocr:
+        log('running OCR on the unprocessed page', verbose)
+        with tracker.stage('run_ocr_base'):
+            text, conf = utils.run_ocr(base, get_text_path(args, output_path, 'base.txt'), f'./temp/{ed_name}/{page_name}/tess_unproc.png', verbose=verbose)
+        store_page(args, ed_name, page_name, 'base', text, conf)
 
-    if OCR_GRAY:
-        log('running OCR on the grayscale page')
-        utils.run_ocr(f'./temp/{ed_name}/{page_name}/grayscale.png', os.path.join(output_path, 'gray.txt'), f'./temp/{ed_name}/{page_name}/tess_gray.png', verbose=VERBOSE)
+    if OCR_GRAY and extra_ocr:
+        log('running OCR on the grayscale page', verbose)
+        if utils.WRITER is not None:
+            utils.WRITER.flush() # grayscale.png is written by prepare_image
+        with tracker.stage('run_ocr_gray'):
+            text, conf = utils.run_ocr(f'./temp/{ed_name}/{page_name}/grayscale.png', get_text_path(args, output_path, 'gray.txt'), f'./temp/{ed_name}/{page_name}/tess_gray.png', verbose=verbose)
+        store_page(args, ed_name, page_name, 'gray', text, conf)
 
     if OCR_PROCESSED:
-        log('running OCR on the processed page')
-        utils.run_ocr(f'./temp/{ed_name}/{page_name}.png', os.path.join(output_path, 'proc.txt'), f'./temp/{ed_name}/{page_name}/tess_proc.png', treat_confidence=True, verbose=VERBOSE)
-    
+        log('running OCR on the processed page', verbose)
+        with tracker.stage('run_ocr'):
+            column_images = []
+            use_atlas = args.atlas and do_mhs
+            if args.columns and not use_atlas and not degraded:
+                columns_folder = f'./temp/{ed_name}/{page_name}/columns'
+                os.makedirs(columns_folder, exist_ok=True)
+                column_images, _, _ = detect_columns_projection(image, columns_folder, verbose=verbose)
+                log(f'found {len(column_images)} columns', verbose)
+            data = None
+            page_image = image
+            if use_atlas:
+                # the regions are read before the final deskew, in the coordinates of the prepared page
+                text, conf, data = ocr_regions(segmented, coords, f'./temp/{ed_name}/{page_name}', verbose=verbose)
+                page_image = cv2.bitwise_not(segmented) # the image the word boxes belong to, black on white as the deskewed page
+                text_path = get_text_path(args, output_path, 'proc.txt')
+                if text_path:
+                    utils.write_text(text, text_path)
+            elif len(column_images) > 0:
+                text, conf = utils.run_ocr_on_columns(column_images, columns_folder, get_text_path(args, output_path, 'proc.txt'), verbose=verbose)
+            else:
+                text, conf, data = utils.run_ocr(image, get_text_path(args, output_path, 'proc.txt'), f'./temp/{ed_name}/{page_name}/tess_proc.png', treat_confidence=True, verbose=verbose, return_data=True)
+        store_page(args, ed_name, page_name, 'proc', text, conf, data, page_image)
+        index_page(args, ed_name, page_name, text, get_text_path(args, output_path, 'proc.txt'))
+
+    record_hash(args, ed_name, page_name, page_hash, page_thumb, duplicate_of)
+    log(f'DONE with page "{page_name}" from "{ed_name}"', verbose)
+    return tracker.report()
+
+def process_spread(args: argparse.Namespace, ed_name: str, page_name: str, page: str, image=None) -> dict:
+    '''Split a two page scan and run the pipeline on both pages in parallel threads.
+
+    The pages are named <page_name>_1 and <page_name>_2. Memory is traced for
+    the whole process, so the peak of each stage includes the other page.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+        ed_name (str): name of the edition
+        page_name (str): name of the scan
+        page (str): path to the scan
+        image (cv2 image): the scan if it was already loaded, otherwise it is read from page. default=None
+
+    Returns:
+        dict: time and memory measurements of both pages, see merge_reports
+    '''
+    tracker = StageTracker(track_memory=args.memory_report)
+    page_names = [f'{page_name}_{i + 1}' for i in range(2)]
+    cropped_paths = [utils.get_intermediate_path(f'./temp/{ed_name}/{name}/cropped.png', args.intermediate_format) for name in page_names]
+    if args.reuse_intermediates and all(os.path.exists(path) for path in cropped_paths):
+        # process_page loads the cropped pages, the scan is not read at all
+        log(f'reusing the pages of spread "{page_name}" from "{ed_name}"', args.verbose)
+        process = lambda i: process_page(args, ed_name, page_names[i], page, spread=True)
+    else:
+        if image is None:
+            with tracker.stage('load_image'):
+                image = utils.load_image(page)
+        os.makedirs(f'./temp/{ed_name}/{page_name}', exist_ok=True)
+        log(f'splitting spread "{page_name}" from "{ed_name}"', args.verbose)
+        with tracker.stage('extract_pages'):
+            pages = extract_pages(image, f'./temp/{ed_name}/{page_name}/', scale=args.detection_scale)
+        process = lambda i: process_page(args, ed_name, page_names[i], page, pages[i][0], cropped=True, spread=True)
+    with ThreadPoolExecutor(max_workers=len(page_names)) as executor:
+        reports = list(executor.map(process, range(len(page_names))))
+    return merge_reports(tracker, reports)
+
+def process_scan(args: argparse.Namespace, ed_name: str, page_name: str, page: str, image=None) -> dict:
+    '''Run the pipeline on a scan, as a spread if the flag --spread is used, tracing memory only with --memory-report.'''
+    with trace_memory(args.memory_report):
+        if args.spread:
+            return process_spread(args, ed_name, page_name, page, image)
+        return process_page(args, ed_name, page_name, page, image)
+
+def record_memory(args: argparse.Namespace, ed_name: str, page_name: str, page: str, report: dict):
+    '''Log the memory measurements of a page, if they were taken.'''
+    if report['peak_bytes'] is None:
+        return
+    width, height = utils.get_image_size(page)
+    write_memory_log(args.memory_log, ed_name, page_name, width * height / 1e6, report)
+    log(f'peak memory of "{page_name}": {format_size(report["peak_bytes"])}, ' +
+        ', '.join(f'{stage} {format_size(values["peak_bytes"])}' for stage, values in report['stages'].items()), args.verbose)
+
+def record_metrics(args: argparse.Namespace, metrics: PipelineMetrics, pending: int, report: dict = None, outcome: str = None):
+    '''Add a finished page to the metrics, if they are exported, see PipelineMetrics.observe.'''
+    if metrics is None:
+        return
+    metrics.observe(report, outcome)
+    metrics.set_pending(pending)
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+
+def get_megapixels(page: str) -> float:
+    '''Get the size of a page image in megapixels, 0 if it cannot be read, so it fails once it is processed.'''
+    try:
+        width, height = utils.get_image_size(page)
+    except Exception:
+        return 0
+    return width * height / 1e6
+
+def count_pending(jobs: JobQueue) -> int:
+    counts = jobs.counts()
+    return counts.get('pending', 0) + counts.get('running', 0)
+
+def drain_queue(args: argparse.Namespace, jobs: JobQueue, metrics: PipelineMetrics = None):
+    '''Process pages from the queue until there are none left.'''
+    while True:
+        job = jobs.lease()
+        if job is None:
+            break
+        job_id, ed_name, page_name, page = job
+        try:
+            with jobs.heartbeat(job_id): # a page longer than the lease is not given to another worker
+                report = process_scan(args, ed_name, page_name, page)
+                if utils.WRITER is not None:
+                    utils.WRITER.flush() # the page is done only once its outputs are on disk
+        except Exception as e:
+            log(f'failed page "{page_name}" from "{ed_name}": {e!r}', True)
+            if not jobs.fail(job_id, repr(e)):
+                log(f'the lease of page "{page_name}" from "{ed_name}" had expired, it belongs to another worker', True)
+            record_metrics(args, metrics, count_pending(jobs), outcome='failed')
+            continue
+        if not jobs.complete(job_id, report):
+            log(f'the lease of page "{page_name}" from "{ed_name}" had expired, it belongs to another worker', True)
+        record_metrics(args, metrics, count_pending(jobs), report)
+        record_memory(args, ed_name, page_name, page, report)
+    counts = jobs.counts()
+    log(f'queue is empty: {counts.get("done", 0)} pages done, {counts.get("failed", 0)} failed', args.verbose)
+
+def list_pages(folder: str) -> 'list[str]':
+    '''List the page images of an edition folder, sorted by name.
+
+    A page saved both as PNG and JPG, e.g. rendered by one run and extracted
+    by another, is listed once, as the lossless PNG.
+    '''
+    pages = {}
+    for page in glob.glob(f'{folder}/*.jpg') + glob.glob(f'{folder}/*.png'):
+        pages[utils.get_name(page)] = page # the PNGs come last and replace the JPGs
+    return [pages[name] for name in sorted(pages)]
+
+def main():
+    args = get_parser().parse_args()
+    verbose = args.verbose
+
+    input_files = []
+    for input_file in args.input:
+        input_files.extend(glob.glob(input_file))
+
+    os.makedirs('./input/processed', exist_ok=True)
+    if args.pdf:
+        log('converting PDFs into PNGs', verbose)
+        convert_pdfs(input_files, './input/processed', verbose, is_dev=not args.production, extract_images=args.extract_images)
+
+    all_files = []
+
+    editions = [f'./input/processed/{args.edition}'] if args.edition else glob.glob('./input/processed/*')
+    for ed in editions:
+        ed_name = unidecode(utils.get_name(ed, 0).lower())
+        for page in list_pages(ed):
+            all_files.append((ed_name, utils.get_name(page), page))
+
+    if args.memory_report or args.memory_budget:
+        os.makedirs(os.path.dirname(args.memory_log) or '.', exist_ok=True)
+    if args.triage:
+        os.makedirs(os.path.dirname(args.triage_log) or '.', exist_ok=True)
+    if args.store:
+        os.makedirs(args.store, exist_ok=True)
+    if args.metrics_file:
+        os.makedirs(os.path.dirname(args.metrics_file) or '.', exist_ok=True)
+
+    metrics = PipelineMetrics() if args.metrics_file or args.metrics_port else None
+    server = None
+    if args.metrics_port:
+        server = serve_metrics(metrics, args.metrics_port)
+        log(f'serving metrics on http://127.0.0.1:{args.metrics_port}/metrics', verbose)
+    try:
+        run(args, all_files, metrics)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+def run(args: argparse.Namespace, all_files: 'list[tuple[str, str, str]]', metrics: PipelineMetrics = None):
+    '''Process the pages serially, concurrently within the memory budget or from the queue.'''
+    verbose = args.verbose
+
+    if args.queue:
+        jobs = JobQueue(args.queue, args.lease, args.max_attempts)
+        log(f'{jobs.enqueue(all_files)} pages added to the queue', verbose)
+        writer = AsyncWriter(args.write_queue) if args.write_queue > 0 else None
+        utils.set_writer(writer)
+        try:
+            drain_queue(args, jobs, metrics)
+        finally:
+            if writer is not None:
+                utils.set_writer(None)
+                writer.close()
+            jobs.close()
+        return
+
+    if not args.memory_budget:
+        writer = AsyncWriter(args.write_queue) if args.write_queue > 0 else None
+        utils.set_writer(writer)
+        pages = PageReader(all_files, args.prefetch) if args.prefetch > 0 else ((f, None, None) for f in all_files)
+        try:
+            for i, ((ed_name, page_name, page), image, error) in enumerate(tqdm(pages, total=len(all_files))):
+                try:
+                    if error is not None:
+                        raise error # the prefetched page could not be read
+                    report = process_scan(args, ed_name, page_name, page, image)
+                except Exception as e:
+                    log(f'failed page "{page_name}" from "{ed_name}": {e!r}', True)
+                    record_metrics(args, metrics, len(all_files) - i - 1, outcome='failed')
+                    continue
+                record_memory(args, ed_name, page_name, page, report)
+                record_metrics(args, metrics, len(all_files) - i - 1, report)
+        finally:
+            if isinstance(pages, PageReader):
+                pages.close()
+            if writer is not None:
+                utils.set_writer(None)
+                writer.close()
+        return
+
+    budget = parse_size(args.memory_budget)
+    process_bytes = peak_rss() or 0
+    footprint = read_footprint(args.memory_log)
+    while footprint is None and len(all_files) > 0:
+        # no measurements yet, calibrate with the first page that does not fail
+        log('measuring the memory footprint on the first page', verbose)
+        ed_name, page_name, page = all_files.pop(0)
+        try:
+            # only this page is traced, unless --memory-report, as tracing slows the pages down
+            report = process_scan(argparse.Namespace(**{ **vars(args), 'memory_report': True }), ed_name, page_name, page)
+        except Exception as e:
+            log(f'failed page "{page_name}" from "{ed_name}": {e!r}', True)
+            record_metrics(args, metrics, len(all_files), outcome='failed')
+            continue
+        record_memory(args, ed_name, page_name, page, report)
+        record_metrics(args, metrics, len(all_files), report)
+        footprint = read_footprint(args.memory_log)
+        break
+    if len(all_files) == 0:
+        return
+
+    megapixels = max(get_megapixels(page) for _, _, page in all_files)
+    workers = estimate_workers(budget, footprint, megapixels, process_bytes)
+    log(f'{format_size(footprint)} per megapixel, largest page has {megapixels:.1f} megapixels; running {workers} pages at a time within {format_size(budget)}', verbose)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(process_scan, args, *f): f for f in all_files }
+        for i, future in enumerate(tqdm(as_completed(futures), total=len(futures))):
+            try:
+                report = future.result()
+            except Exception as e:
+                ed_name, page_name, _ = futures[future]
+                log(f'failed page "{page_name}" from "{ed_name}": {e!r}', True)
+                record_metrics(args, metrics, len(futures) - i - 1, outcome='failed')
+                continue
+            record_memory(args, *futures[future], report)
+            record_metrics(args, metrics, len(futures) - i - 1, report)
 
-    log(f'DONE with page "{page_name}" from "{ed_name}"')
+if __name__ == '__main__':
+    main()
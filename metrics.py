@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STAGE_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300] # upper bounds of the latency histograms, in seconds
+
+def escape(value) -> str:
+    '''Escape a label value of the Prometheus text format.'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: 'list[str]', values: tuple, extra: str = '') -> str:
+    '''Format the labels of a sample, e.g. {stage="deskew",le="0.5"}.'''
+    labels = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric:
+    '''Values of a metric by label values, in the Prometheus text format.
+
+    Args:
+        name (str): metric name, e.g. ocr_pages_total
+        help (str): description of the metric
+        labels (list[str]): label names. default=[]
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: 'list[str]' = []):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def samples(self) -> 'list[str]':
+        return [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in sorted(self.values.items())]
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + self.samples())
+
+
+class Counter(Metric):
+    '''Count that only goes up, e.g. of processed pages.'''
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''Value that goes up and down, e.g. the pages left.'''
+    kind = 'gauge'
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    '''Distribution of observed values in cumulative buckets, e.g. of stage latencies.
+
+    Args:
+        buckets (list[float]): upper bounds of the buckets, in increasing order. default=STAGE_BUCKETS
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: 'list[str]' = [], buckets: 'list[float]' = STAGE_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+        for i, bound in enumerate(self.buckets + [float('inf')]):
+            if value <= bound:
+                counts[i] += 1
+        self.values[labels] = (counts, total + value)
+
+    def samples(self) -> 'list[str]':
+        samples = []
+        for key, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                le = f'le="{bound}"'
+                samples.append(f'{self.name}_bucket{format_labels(self.labels, key, le)} {count}')
+            samples.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+            samples.append(f'{self.name}_count{format_labels(self.labels, key)} {counts[-1]}')
+        return samples
+
+
+class PipelineMetrics:
+    '''Throughput, latency and error metrics of a run, fed with the page reports.
+
+    Exposes the pages processed by outcome, the latency of each stage and
+    of whole pages, the pages left and the time of the last finished page,
+    so a stalled worker shows as a growing gap to the current time.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = Counter('ocr_pages_total', 'Pages finished, by outcome: done, fallback, degraded, skipped, reused or failed.', ['outcome'])
+        self.stage_seconds = Histogram('ocr_stage_seconds', 'Seconds taken by each stage of a page.', ['stage'])
+        self.page_seconds = Histogram('ocr_page_seconds', 'Seconds taken by all the stages of a page.')
+        self.pending = Gauge('ocr_pages_pending', 'Pages left to process, including the ones other workers hold in a shared queue.')
+        self.last_page = Gauge('ocr_last_page_timestamp_seconds', 'Unix time at which the last page finished.')
+        self.started = Gauge('ocr_start_timestamp_seconds', 'Unix time at which the run started.')
+        self.started.set(time.time())
+
+    def observe(self, report: dict = None, outcome: str = None):
+        '''Record a finished page.
+
+        Args:
+            report (dict): time measurements of the page, see StageTracker.report. None if it failed
+            outcome (str): how the page finished, the outcome of the report by default. A
+                report of a spread, see merge_reports, counts each of its pages
+        '''
+        outcomes = [outcome] if outcome else report.get('outcomes', [report.get('outcome', 'done')])
+        with self.lock:
+            for o in outcomes:
+                self.pages.inc(o)
+            if report is not None:
+                for stage, values in report['stages'].items():
+                    self.stage_seconds.observe(values['seconds'], stage)
+                self.page_seconds.observe(sum(v['seconds'] for v in report['stages'].values()))
+            self.last_page.set(time.time())
+
+    def set_pending(self, count: int):
+        with self.lock:
+            self.pending.set(count)
+
+    def render(self) -> str:
+        '''Get every metric in the Prometheus text format.'''
+        with self.lock:
+            metrics = [self.pages, self.stage_seconds, self.page_seconds, self.pending, self.last_page, self.started]
+            return '\n'.join(m.render() for m in metrics) + '\n'
+
+    def write(self, path: str):
+        '''Replace a file with the metrics, e.g. for the textfile collector of the node exporter.'''
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(temp_path, path) # readers never see a partial file
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''Answer GET /metrics with the metrics of the run.'''
+    metrics = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(metrics: PipelineMetrics, port: int) -> ThreadingHTTPServer:
+    '''Serve the metrics on http://127.0.0.1:<port>/metrics from a background thread.
+
+    Returns:
+        ThreadingHTTPServer: the server, to shutdown once the run finishes
+    '''
+    handler = type('Handler', (MetricsHandler,), { 'metrics': metrics })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,6 +1,36 @@
 import cv2
 import numpy as np
 from utils import conditional_save, get_conditional_path
+from bitmap import Bitmap
+from profiling import Deadline, DeadlineExceeded
+
+def projection(R, axis: int) -> np.ndarray:
+    '''Count the filled pixels of a region along an axis.
+
+    Args:
+        R (cv2 image or Bitmap): region to project
+        axis (int): axis to project
+    
+    Returns:
+        np.ndarray: number of pixels > 0 on each row (axis=1) or column (axis=0)
+    '''
+    return R.count(axis) if isinstance(R, Bitmap) else np.sum(R > 0, axis)
+
+
+def ink(R) -> int:
+    '''Count the filled pixels of a region (cv2 image or Bitmap).'''
+    return R.count() if isinstance(R, Bitmap) else np.count_nonzero(R)
+
+
+def blank_like(R):
+    '''Create an empty region of the same shape and type (cv2 image or Bitmap).'''
+    return Bitmap.zeros(R.shape) if isinstance(R, Bitmap) else np.zeros_like(R)
+
+
+def as_image(R):
+    '''Get a region as a cv2 image, unpacking it if it is a Bitmap.'''
+    return R.to_image() if isinstance(R, Bitmap) else R
+
 
 def cc_analisys(img) -> 'tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]':
     '''Find connected components and extract features from them.
@@ -94,7 +124,7 @@ def get_gradient(R, s: int, axis: int = 1, t: int = 0) -> np.ndarray:
         np.ndarray: gradient of the projection
 
     '''
-    ph = np.sum(R > 0, axis)
+    ph = projection(R, axis)
     ph[ph<t] = 0
     zh = np.zeros_like(ph)
     # s = int(ph.shape[0] * 0.05)
@@ -149,7 +179,7 @@ def get_lines(R, axis: int, t: int = 0) -> 'tuple[tuple[list[int], list[int]], t
         tuple[tuple[list[int], list[int]], tuple[list[int], list[int]]]: index
         and heights of the white lines and black lines found.
     '''
-    p = np.sum(R > 0, axis=axis)
+    p = projection(R, axis)
 
     flags = np.zeros_like(p, dtype=np.bool)
     heights = np.zeros_like(p)
@@ -257,7 +287,7 @@ def get_division(R, axis: int, t: int = 0) -> 'list[tuple[int, int]]':
     return divs
 
 
-def recursive_splitting(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t: float = 0.01, do_filter: bool = True) -> 'tuple[list, list[np.ndarray]]':
+def recursive_splitting(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t: float = 0.01, do_filter: bool = True, deadline: Deadline = None, max_regions: int = None) -> 'tuple[list, list[np.ndarray]]':
     '''Split an image into homogeneous regions.
 
     Use the method describe by (Tran et al. 2016) to split the image into
@@ -270,9 +300,14 @@ def recursive_splitting(img, rect: np.ndarray, is_text: np.ndarray, area: np.nda
         area (np.ndarray): area (number of filled pixels) for each CCs
         t (float): the threshold of pixels to ignore when computing homogeneity
         do_filter (bool): whether to execute the recursive filter when splitting.
+        deadline (Deadline): checked before each region is split. default=None
+        max_regions (int): maximum number of regions, e.g. to stop on halftone pictures. default=None
 
     Returns:
         tuple[list, list[np.ndarray]]: list of regions and their coordinates on the original image.
+
+    Raises:
+        DeadlineExceeded: if the deadline passes or the image splits into more than max_regions regions
     '''
     finished_regions = []
     finished_coords = []
@@ -288,6 +323,8 @@ def recursive_splitting(img, rect: np.ndarray, is_text: np.ndarray, area: np.nda
         new_homo = []
         new_coords = []
         for i in range(len(regions)):
+            if deadline is not None:
+                deadline.check()
             # print('in', coords[i])
             x, y, w, h = coords[i]
             # s = int(np.sqrt(w*h) * 0.05)
@@ -335,6 +372,8 @@ def recursive_splitting(img, rect: np.ndarray, is_text: np.ndarray, area: np.nda
                     finished_coords.append(coords[i])
                     
         # print('scanned', len(regions), 'regions.', len(new_regions), 'new regions found')
+        if max_regions is not None and len(finished_regions) + len(new_regions) > max_regions:
+            raise DeadlineExceeded(f'splitting found more than {max_regions} regions')
 
         regions = new_regions
         homo = new_homo
@@ -354,8 +393,8 @@ def converge(region, after_filter) -> bool:
     Returns:
         bool: True if the algorithm converged for this region
     '''
-    Su = np.sum(region)
-    Sv = np.sum(after_filter)
+    Su = ink(region)
+    Sv = ink(after_filter)
     return Su == Sv or Sv == 0
 
 
@@ -528,13 +567,48 @@ def recursive_filter(region, coords: np.ndarray, rect: np.ndarray, is_text: np.n
     for x,y,w,h in CCu[non_text]:
         x -= coords[0]
         y -= coords[1]
-        cv2.rectangle(region, (x, y), (x+w, y+h), 0, -1)
+        if isinstance(region, Bitmap):
+            region.fill(x, y, x+w+1, y+h+1)
+        else:
+            cv2.rectangle(region, (x, y), (x+w, y+h), 0, -1)
         is_text[is_text][indicies[i]] = False
         i += 1
 
 
+### Multi-resolução
+def downscale_binary(img, scale: float):
+    '''Downscale an inverse binary image without losing thin strokes.
+
+    Args:
+        img (cv2 image): inverse binary image
+        scale (float): scale factor, e.g. 0.25
+    
+    Returns:
+        cv2 image: inverse binary image where any pixel covering ink is set
+    '''
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.threshold(small, 0, 255, cv2.THRESH_BINARY)[1]
+
+
+def upscale_region(coords: 'tuple[int, int, int, int]', scale: float, shape: 'tuple[int, int]') -> 'tuple[int, int, int, int]':
+    '''Map the bounding box of a region found on a downscaled image back to full resolution.
+
+    Args:
+        coords (tuple[int, int, int, int]): bounding box (x, y, w, h) on the downscaled image
+        scale (float): scale factor used to downscale the image
+        shape (tuple[int, int]): shape of the full resolution image
+    
+    Returns:
+        tuple[int, int, int, int]: bounding box (x, y, w, h) on the full resolution image
+    '''
+    x, y, w, h = coords
+    x1, y1 = int(np.floor(x / scale)), int(np.floor(y / scale))
+    x2, y2 = min(int(np.ceil((x + w) / scale)), shape[1]), min(int(np.ceil((y + h) / scale)), shape[0])
+    return (x1, y1, x2-x1, y2-y1)
+
+
 ### Classificação Multi-Layer
-def multi_layer(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t: float = 0):
+def multi_layer(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t: float = 0, scale: float = 1.0, deadline: Deadline = None):
     '''Apply the multy-layer classification to an image.
 
     Use the method described by (Tran et al. 2017) to eliminate further non-text
@@ -546,18 +620,24 @@ def multi_layer(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t:
         is_text (np.ndarray): boolean mask for the text CCs
         area (np.ndarray): area (number of filled pixels) for each CCs
         t (float): the threshold of pixels to ignore
+        scale (float): scale in which to compute the divisions, the CCs are always filtered in full resolution. default=1.0
+        deadline (Deadline): checked before each region is filtered. default=None
     
     Returns:
         cv2 image: text image after the removal of all the non-text elements
+
+    Raises:
+        DeadlineExceeded: if the deadline passes before the filter converges
     '''
-    prev = img.copy() * 0
+    prev = blank_like(img)
     current = img.copy()
     i = 0
     while not converge(prev, current):
         rs = []
         cs = []
-        hdivs = get_division(current, 1, int(img.shape[0] * t))
-        vdivs = get_division(current, 0, int(img.shape[1] * t))
+        grid = downscale_binary(as_image(current), scale) if scale < 1 else current
+        hdivs = get_division(grid, 1, int(grid.shape[0] * t))
+        vdivs = get_division(grid, 0, int(grid.shape[1] * t))
         divs = []
         for h in hdivs:
             for v in vdivs:
@@ -567,12 +647,17 @@ def multi_layer(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t:
 
         for x1,x2,y1,y2 in divs:
             rct = (x1, y1, x2-x1, y2-y1)
+            if scale < 1:
+                rct = upscale_region(rct, scale, img.shape)
+                x1, y1, x2, y2 = rct[0], rct[1], rct[0] + rct[2], rct[1] + rct[3]
             cs.append(rct)
             rs.append(current[y1:y2, x1:x2])
         
         prev = current
-        current = current.copy() * 0
+        current = blank_like(current)
         for i in range(len(rs)):
+            if deadline is not None:
+                deadline.check()
             recursive_filter(rs[i], cs[i], rect, is_text, area)
             x,y,w,h = cs[i]
             current[y:y+h, x:x+w] = rs[i]
@@ -581,7 +666,48 @@ def multi_layer(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t:
     return current
 
 
-def segment(img_bw, temp_folder: str = None, output_path: str = None) -> 'tuple[np.ndarray, list, list[np.ndarray]]':
+def split_regions(img, rect: np.ndarray, is_text: np.ndarray, area: np.ndarray, t: float = 0.01, do_filter: bool = True, scale: float = 1.0, deadline: Deadline = None, max_regions: int = None) -> 'tuple[list, list[np.ndarray]]':
+    '''Split an image into homogeneous regions, optionally at a lower resolution.
+
+    When scale < 1 the region layout is found with recursive_splitting on a
+    downscaled copy of the image, the regions are mapped back and, if
+    do_filter, the recursive filter is applied to each one in full resolution.
+
+    Args:
+        img (cv2 image): the image to split
+        rect (np.ndarray): bounding box of the all the CCs
+        is_text (np.ndarray): boolean mask for the text CCs
+        area (np.ndarray): area (number of filled pixels) for each CCs
+        t (float): the threshold of pixels to ignore when computing homogeneity
+        do_filter (bool): whether to execute the recursive filter on the regions.
+        scale (float): scale in which to find the regions. default=1.0
+        deadline (Deadline): see recursive_splitting, also checked before each region is filtered in full resolution. default=None
+        max_regions (int): see recursive_splitting. default=None
+
+    Returns:
+        tuple[list, list[np.ndarray]]: list of regions and their coordinates on the original image.
+    '''
+    if scale >= 1:
+        return recursive_splitting(img, rect, is_text, area, t=t, do_filter=do_filter, deadline=deadline, max_regions=max_regions)
+
+    _, small_cs = recursive_splitting(downscale_binary(as_image(img), scale), rect, is_text, area, t=t, do_filter=False, deadline=deadline, max_regions=max_regions)
+    rs, cs = [], []
+    for c in small_cs:
+        if deadline is not None:
+            deadline.check()
+        x, y, w, h = upscale_region(c, scale, img.shape)
+        if do_filter:
+            region = img[y:y+h, x:x+w].copy()
+            recursive_filter(region, (x, y, w, h), rect, is_text, area)
+        else:
+            region = img[y:y+h, x:x+w]
+        rs.append(region)
+        cs.append((x, y, w, h))
+    
+    return rs, cs
+
+
+def segment(img_bw, temp_folder: str = None, output_path: str = None, scale: float = 1.0, packed: bool = False, t: float = 0.01, deadline: Deadline = None, max_regions: int = None) -> 'tuple[np.ndarray, list, list[np.ndarray]]':
     '''Segment an image using an MHS based approach.
 
     Implements a MHS (Tran et al. 2017) based approach for document text region
@@ -591,10 +717,21 @@ def segment(img_bw, temp_folder: str = None, output_path: str = None) -> 'tuple[
         img_bw (cv2 image): binarized image to segment
         temp_folder (str): folder to save intermediary files to, if None does not save. default=None
         output_path (str): path to the resulting image with only text elements, if None does not save. default=None
+        scale (float): scale in which to find the region layout, e.g. 0.25. The
+            CC analysis and text/non-text classification always run in full resolution. default=1.0
+        packed (bool): run the splitting and the filters on a 1 bit per pixel Bitmap
+            instead of the uint8 image, the results are unpacked at the end. default=False
+        t (float): the threshold of pixels to ignore when computing homogeneity,
+            in the region splitting and the multi-layer filter. default=0.01
+        deadline (Deadline): time limit checked by the splitting and the filters. default=None
+        max_regions (int): maximum number of regions of each splitting. default=None
     
     Returns:
         tuple[np.ndarray, list, list[np.ndarray]]: the text document, a list of
         all the regions and all of their coordinates.
+
+    Raises:
+        DeadlineExceeded: if the deadline passes or a splitting finds more than max_regions regions
     '''
 
     _, thresh = cv2.threshold(img_bw, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
@@ -602,62 +739,70 @@ def segment(img_bw, temp_folder: str = None, output_path: str = None) -> 'tuple[
 
     thresh, is_text = heuristic_filter(thresh, area, density, rect, inc, hw_rate)
     conditional_save(thresh, get_conditional_path('heuristic_filter.png', temp_folder))
+    if packed:
+        thresh = Bitmap.from_image(thresh)
 
     # in case there is a text element that is now empty, make it non-text
     for i in range(rect.shape[0]):
         if is_text[i]:
             x,y,w,h = rect[i]
-            is_text[i] = np.any(thresh[y:y+h,x:x+w] > 0)
+            is_text[i] = ink(thresh[y:y+h,x:x+w]) > 0
     
     if temp_folder:
-        img_boxes = thresh.copy()
+        img_boxes = as_image(thresh).copy()
         for r in rect[is_text]:
             x,y,w,h = r
             cv2.rectangle(img_boxes, (x,y), (x+w,y+h), 128, 2)
         conditional_save(img_boxes, get_conditional_path('text_ccs.png', temp_folder))
     
     # print('before:', is_text.sum())
-    rs, cs = recursive_splitting(thresh, rect, is_text, area, t=0.01)
+    rs, cs = split_regions(thresh, rect, is_text, area, t=t, scale=scale, deadline=deadline, max_regions=max_regions)
     # print('after:', is_text.sum())
     
     # remove empty(-ish) regions
-    new_rs = [rs[i] for i in range(len(rs)) if np.sum(rs[i] > 0) / (cs[i][2]*cs[i][3]) > 0.01]
-    new_cs = [cs[i] for i in range(len(rs)) if np.sum(rs[i] > 0) / (cs[i][2]*cs[i][3]) > 0.01]
+    new_rs = [rs[i] for i in range(len(rs)) if ink(rs[i]) / (cs[i][2]*cs[i][3]) > 0.01]
+    new_cs = [cs[i] for i in range(len(rs)) if ink(rs[i]) / (cs[i][2]*cs[i][3]) > 0.01]
     
     rs, cs = new_rs, new_cs
 
     if temp_folder:
-        img_boxes = thresh.copy()
+        img_boxes = as_image(thresh).copy()
         for r in cs:
             x,y,w,h = r
             cv2.rectangle(img_boxes, (x,y), (x+w,y+h), 128, 2)
         conditional_save(img_boxes, get_conditional_path('multilevel_regions.png', temp_folder))
         
-    img = thresh.copy() * 0
+    img = blank_like(thresh)
     for i in range(len(rs)):
         x,y,w,h = cs[i]
         img[y:y+h, x:x+w] = rs[i]
-    conditional_save(img_boxes, get_conditional_path('multi_level.png', temp_folder))
+    if temp_folder:
+        conditional_save(as_image(img), get_conditional_path('multi_level.png', temp_folder))
     
     # remove the text CCs now empty
     CCt = np.argwhere(is_text).flatten()
     for i in CCt:
         x,y,w,h = rect[i]
-        if np.sum(img[y:y+h, x:x+w] > 0) == 0:
+        if ink(img[y:y+h, x:x+w]) == 0:
             is_text[i] = False
 
 
     # print('before:', is_text.sum())
-    img = multi_layer(img, rect, is_text, area, t=0.01)
+    img = multi_layer(img, rect, is_text, area, t=t, scale=scale, deadline=deadline)
     # print('after:', is_text.sum())
-    conditional_save(img, get_conditional_path('multi_layer.png', temp_folder))
+    if temp_folder:
+        conditional_save(as_image(img), get_conditional_path('multi_layer.png', temp_folder))
     
     ### Segmentação de Regiões Homogêneas
-    rs, cs = recursive_splitting(img, rect, is_text, area, t=0, do_filter=False)
-    new_rs = [rs[i] for i in range(len(rs)) if np.sum(rs[i] > 0) / (cs[i][2]*cs[i][3]) > 0.01]
-    new_cs = [cs[i] for i in range(len(rs)) if np.sum(rs[i] > 0) / (cs[i][2]*cs[i][3]) > 0.01]
+    rs, cs = split_regions(img, rect, is_text, area, t=0, do_filter=False, scale=scale, deadline=deadline, max_regions=max_regions)
+    new_rs = [rs[i] for i in range(len(rs)) if ink(rs[i]) / (cs[i][2]*cs[i][3]) > 0.01]
+    new_cs = [cs[i] for i in range(len(rs)) if ink(rs[i]) / (cs[i][2]*cs[i][3]) > 0.01]
     rs, cs = new_rs, new_cs
 
+    if packed:
+        img = img.to_image()
+        rs = [r.to_image() for r in rs]
+
     if temp_folder:
         img_boxes = img.copy()
         for r in cs:
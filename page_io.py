@@ -0,0 +1,145 @@
+import queue
+import threading
+import cv2
+
+import utils
+
+END = object() # marks the end of a queue
+
+
+class PageReader:
+    '''Iterate over pages while a background thread decodes the next ones.
+
+    At most depth decoded pages wait in memory; when the queue is full the
+    reader thread blocks until the pipeline takes a page (backpressure).
+
+    Args:
+        pages (list[tuple]): items to read, the path of the image must be their last element
+        depth (int): number of pages to decode ahead. default=2
+        load (callable): function that reads an image from a path. default=utils.load_image
+    '''
+    def __init__(self, pages: 'list[tuple]', depth: int = 2, load=utils.load_image):
+        self.pages = pages
+        self.load = load
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _put(self, value) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        for page in self.pages:
+            try:
+                value = (page, self.load(page[-1]), None)
+            except Exception as e:
+                value = (page, None, e)
+            if not self._put(value):
+                return
+        self._put(END)
+
+    def __iter__(self):
+        '''Yield (item, image, error) for each page, error being the exception raised reading it, if any.
+
+        A page that cannot be read does not stop the iteration, the caller
+        raises the error where it handles the failures of a page.
+        '''
+        try:
+            while True:
+                value = self.queue.get()
+                if value is END:
+                    return
+                yield value
+        finally:
+            self.close()
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def close(self):
+        '''Stop the reader thread and wait for it to finish the page it is reading.'''
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class AsyncWriter:
+    '''Write images and texts to disk from a background thread.
+
+    The queued images are kept by reference, so they must not be modified
+    after being handed to the writer. When depth writes are pending, new
+    writes block until the disk catches up (backpressure). Errors are raised on
+    the next write, flush or close.
+
+    Args:
+        depth (int): maximum number of pending writes. default=16
+    '''
+    def __init__(self, depth: int = 16):
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            value = self.queue.get()
+            try:
+                if value is END:
+                    return
+                kind, path, content = value
+                if kind == 'image':
+                    if not cv2.imwrite(path, content):
+                        raise IOError(f'failed to write image to "{path}"')
+                elif kind == 'array':
+                    utils.write_array(content, path)
+                else:
+                    with open(path, 'w', encoding='utf-8') as f:
+                        f.write(content)
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save_image(self, path: str, image):
+        '''Queue an image to be written with cv2.imwrite.'''
+        self._check()
+        self.queue.put(('image', path, image))
+
+    def save_array(self, path: str, array):
+        '''Queue an array to be written with utils.write_array.'''
+        self._check()
+        self.queue.put(('array', path, array))
+
+    def write_text(self, path: str, text: str):
+        '''Queue a text to be written as utf-8.'''
+        self._check()
+        self.queue.put(('text', path, text))
+
+    def flush(self):
+        '''Wait until every pending write is on disk.'''
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        '''Flush and stop the writer thread.'''
+        self.queue.put(END)
+        self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,21 +1,97 @@
-import pdf2image
 import glob
 import os
 
-def convert_pdfs(input_files=[], output_folder='./tmp', verbose=False, is_dev=True):
+RENDER_DPI = 200           # resolution of the rendered pages, the default of pdf2image
+RENDER_PREFIX = 'page0001' # name pdf2image gives the output_file 'page' of its single pdftoppm call, which adds -<page number>
+
+def import_pymupdf():
+    '''Import PyMuPDF, which older versions name fitz, None if it is not installed.'''
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf
+        except ImportError:
+            return None
+    return pymupdf
+
+def get_scan_image(page) -> int:
+    '''Get the xref of the image a scanned page is made of, None if the page has anything else on it.'''
+    if page.rotation != 0 or page.get_text().strip() or page.get_drawings():
+        return None
+    images = page.get_images(full=True)
+    if len(images) != 1 or images[0][1] != 0: # a single image with no transparency mask
+        return None
+    xref = images[0][0]
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    upright = matrix.b == 0 and matrix.c == 0 and matrix.a > 0 and matrix.d > 0
+    covers = rect.width >= 0.95 * page.rect.width and rect.height >= 0.95 * page.rect.height
+    return xref if upright and covers else None
+
+def save_scan_image(doc, xref: int, output: str) -> str:
+    '''Write an embedded image at its native resolution, keeping the original bytes of JPEGs and PNGs.'''
+    pymupdf = import_pymupdf()
+    info = doc.extract_image(xref)
+    if info['ext'] in ['jpeg', 'jpg', 'png'] and info['colorspace'] != 4:
+        path = f'{output}.{"png" if info["ext"] == "png" else "jpg"}'
+        with open(path, 'wb') as f:
+            f.write(info['image'])
+        return path
+    # JBIG2, CCITT, CMYK and other streams are decoded and saved losslessly
+    pix = pymupdf.Pixmap(doc, xref)
+    if pix.n - pix.alpha > 3:
+        pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+    path = f'{output}.png'
+    pix.save(path)
+    return path
+
+def extract_pdf_images(file_path: str, output: str, verbose: bool = False) -> int:
+    '''Extract the scans of a PDF, rendering only the pages that are not a single image.
+
+    Returns:
+        int: number of pages extracted without rendering
+    '''
+    extracted = 0
+    with import_pymupdf().open(file_path) as doc:
+        digits = len(str(doc.page_count))
+        for page in doc:
+            # the names pdftoppm gives the pages rendered by convert_pdfs, so both ways write the same pages
+            name = os.path.join(output, f'{RENDER_PREFIX}-{page.number + 1:0{digits}d}')
+            xref = get_scan_image(page)
+            if xref is not None:
+                save_scan_image(doc, xref, name)
+                extracted += 1
+            else:
+                page.get_pixmap(dpi=RENDER_DPI).save(f'{name}.png')
+                if verbose: print(f'\trendered page {page.number + 1}, it is not a single image')
+    return extracted
+
+def convert_pdfs(input_files=[], output_folder='./tmp', verbose=False, is_dev=True, extract_images=False):
     def get_name(file_path):
         return file_path.replace('\\', '/').split('/')[-1][:-4]
 
+    if extract_images and import_pymupdf() is None:
+        print('PyMuPDF is not installed, rendering the PDFs instead of extracting their images')
+        extract_images = False
+
     for file_path in input_files:
         name = get_name(file_path)
         if verbose: print('processing file:', name)
-        
+
         output = os.path.join(output_folder, name)
         os.makedirs(output, exist_ok=True)
-        
-        poppler_path = 'C:/Misc/poppler-21.09.0/Library/bin' if is_dev else None
-        pdf2image.convert_from_path(file_path, output_folder=output, output_file='page', poppler_path=poppler_path, fmt='png')
-        
+
+        if extract_images:
+            extracted = extract_pdf_images(file_path, output, verbose)
+            if verbose: print(f'\textracted {extracted} embedded page images')
+        else:
+            import pdf2image
+            poppler_path = 'C:/Misc/poppler-21.09.0/Library/bin' if is_dev else None
+            pdf2image.convert_from_path(file_path, output_folder=output, output_file='page', poppler_path=poppler_path, fmt='png')
+
         if verbose:
-            out_files = [ get_name(f) for f in glob.glob(f'{output}/*.png') ]
+            out_files = [ get_name(f) for f in glob.glob(f'{output}/*.png') + glob.glob(f'{output}/*.jpg') ]
             print(f'\tconverted {len(out_files)} pages:', ','.join(out_files))
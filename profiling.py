@@ -0,0 +1,256 @@
+import os
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def peak_rss() -> int:
+    '''Get the peak resident set size of the current process.
+
+    Returns:
+        int: peak RSS in bytes, None if it can not be measured in this platform
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+def parse_size(text: str) -> int:
+    '''Parse a human readable memory size.
+
+    Args:
+        text (str): size such as "8G", "512M", "1.5GB" or a number of bytes
+
+    Returns:
+        int: size in bytes
+    '''
+    match = re.fullmatch(r'\s*([\d.]+)\s*([kKmMgGtT]?)[bB]?\s*', text)
+    if match is None:
+        raise ValueError(f'invalid memory size "{text}"')
+    value, unit = match.groups()
+    power = ' KMGT'.index(unit.upper()) if unit else 0
+    return int(float(value) * 1024 ** power)
+
+
+def format_size(size: int) -> str:
+    '''Format a number of bytes as a human readable size.
+
+    Args:
+        size (int): size in bytes
+
+    Returns:
+        str: size using the largest fitting unit, e.g. "1.5G"
+    '''
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+
+class DeadlineExceeded(Exception):
+    '''Raised when a page or a stage runs out of its time or work budget.'''
+
+
+class Deadline:
+    '''Point in time by which some work must finish.
+
+    Long loops call check between iterations, so the work stops at the next
+    iteration after the deadline instead of being interrupted.
+
+    Args:
+        seconds (float): seconds from now, None for no limit
+        name (str): what is limited, for the error message. default='page'
+    '''
+    def __init__(self, seconds: float = None, name: str = 'page'):
+        self.name = name
+        self.seconds = seconds
+        self.expires = None if seconds is None else time.monotonic() + seconds
+
+    def limit(self, seconds: float, name: str) -> 'Deadline':
+        '''Get a deadline for part of the work, expiring after some seconds or with this one, whichever is first.
+
+        Args:
+            seconds (float): seconds from now, None for no limit other than this deadline
+            name (str): name of the part, e.g. "segment"
+
+        Returns:
+            Deadline: the earliest of both deadlines
+        '''
+        part = Deadline(seconds, name)
+        return part if self.expires is None or (part.expires is not None and part.expires < self.expires) else self
+
+    def remaining(self) -> float:
+        '''Get the seconds left, None if there is no limit.'''
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def expired(self) -> bool:
+        '''Check if the deadline has passed.'''
+        return self.expires is not None and time.monotonic() > self.expires
+
+    def check(self):
+        '''Raise DeadlineExceeded if the deadline has passed.'''
+        if self.expired():
+            raise DeadlineExceeded(f'{self.name} exceeded its deadline of {self.seconds:g} seconds')
+
+
+@contextmanager
+def trace_memory(enabled: bool = True):
+    '''Context manager that traces memory allocations with tracemalloc, which adds some overhead, for the work in it.
+
+    Tracing is stopped at the end, unless it was already on.
+
+    Args:
+        enabled (bool): whether to trace, so callers need no branch. default=True
+    '''
+    started = enabled and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+class StageTracker:
+    '''Record the duration and the peak memory of each stage of a page.
+
+    Memory is measured with tracemalloc, which accounts for every numpy array
+    (including the ones returned by OpenCV), but not for the buffers OpenCV
+    allocates internally and frees before returning.
+
+    Args:
+        track_memory (bool): whether to measure memory, only while tracing it, see trace_memory. default=False
+    '''
+    def __init__(self, track_memory: bool = False):
+        self.track_memory = track_memory and tracemalloc.is_tracing()
+        self.stages = {}
+        self.peak_bytes = 0
+        self.outcome = 'done' # how the page finished, e.g. skipped by the triage
+
+    @contextmanager
+    def stage(self, name: str):
+        '''Context manager that measures a stage.
+
+        Args:
+            name (str): name of the stage, e.g. "extract_page"
+        '''
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if self.track_memory else None
+            self.stages[name] = { 'seconds': seconds, 'peak_bytes': peak }
+            if peak is not None:
+                self.peak_bytes = max(self.peak_bytes, peak)
+
+    def report(self) -> dict:
+        '''Get the measurements.
+
+        Returns:
+            dict: seconds and peak_bytes of each stage, the page peak, the process peak RSS and the outcome
+        '''
+        return {
+            'stages': self.stages,
+            'outcome': self.outcome,
+            'peak_bytes': self.peak_bytes if self.track_memory else None,
+            'rss_bytes': peak_rss(),
+        }
+
+
+def merge_reports(tracker: StageTracker, reports: 'list[dict]') -> dict:
+    '''Combine the measurements of pages processed together into the report of a tracker.
+
+    Args:
+        tracker (StageTracker): tracker of the work shared by the pages
+        reports (list[dict]): result of StageTracker.report for each page
+
+    Returns:
+        dict: the seconds of each stage added up and the largest peaks, as returned by StageTracker.report,
+        with the outcome of each page in outcomes. The outcome is the first that is not done, if any
+    '''
+    merged = tracker.report()
+    merged['outcomes'] = [report['outcome'] for report in reports]
+    merged['outcome'] = next((o for o in merged['outcomes'] if o != 'done'), merged['outcome'])
+    for report in reports:
+        for stage, values in report['stages'].items():
+            total = merged['stages'].setdefault(stage, { 'seconds': 0.0, 'peak_bytes': values['peak_bytes'] })
+            total['seconds'] += values['seconds']
+            if values['peak_bytes'] is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0, values['peak_bytes'])
+        if report['peak_bytes'] is not None:
+            merged['peak_bytes'] = max(merged['peak_bytes'] or 0, report['peak_bytes'])
+        merged['rss_bytes'] = max(merged['rss_bytes'] or 0, report['rss_bytes'] or 0) or None
+    return merged
+
+
+def write_memory_log(path: str, edition: str, page: str, megapixels: float, report: dict):
+    '''Append the measurements of a page to a tab separated log.
+
+    Args:
+        path (str): path of the log file, created with a header if it does not exist
+        edition (str): edition name
+        page (str): page name
+        megapixels (float): size of the page scan
+        report (dict): result of StageTracker.report
+    '''
+    is_new = not os.path.exists(path)
+    with open(path, 'a', encoding='utf-8') as f:
+        if is_new:
+            f.write('edition\tpage\tmegapixels\tstage\tseconds\tpeak_bytes\n')
+        for stage, values in report['stages'].items():
+            f.write(f"{edition}\t{page}\t{megapixels:.2f}\t{stage}\t{values['seconds']:.3f}\t{values['peak_bytes']}\n")
+        f.write(f"{edition}\t{page}\t{megapixels:.2f}\tpage\t{sum(v['seconds'] for v in report['stages'].values()):.3f}\t{report['peak_bytes']}\n")
+
+
+def read_footprint(path: str) -> float:
+    '''Get the worst measured memory footprint per megapixel from a log.
+
+    Args:
+        path (str): path of a log written by write_memory_log
+
+    Returns:
+        float: peak bytes per megapixel, None if the log has no page measurements
+    '''
+    if not os.path.exists(path):
+        return None
+    footprint = None
+    with open(path, encoding='utf-8') as f:
+        next(f, None)
+        for line in f:
+            _, _, megapixels, stage, _, peak = line.rstrip('\n').split('\t')
+            if stage != 'page' or peak == 'None' or float(megapixels) == 0:
+                continue
+            value = int(peak) / float(megapixels)
+            footprint = value if footprint is None else max(footprint, value)
+    return footprint
+
+
+def estimate_workers(budget: int, bytes_per_megapixel: float, megapixels: float, process_bytes: int = 0, max_workers: int = None) -> int:
+    '''Choose how many pages can run concurrently within a memory budget.
+
+    Args:
+        budget (int): memory available for all the workers, in bytes
+        bytes_per_megapixel (float): measured peak footprint of a page per megapixel
+        megapixels (float): size of the largest page to process
+        process_bytes (int): fixed memory of each worker process (interpreter, libraries). default=0
+        max_workers (int): upper bound, defaults to the number of CPUs
+
+    Returns:
+        int: number of workers, at least 1
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    per_worker = bytes_per_megapixel * megapixels * 1.2 + process_bytes # 20% headroom
+    return max(1, min(max_workers, int(budget // per_worker)))
@@ -0,0 +1,181 @@
+import glob
+import itertools
+import json
+import os
+import time
+from argparse import ArgumentParser
+import cv2
+
+from evaluate_quality import char_accuracy
+from image_prep import deskew, prepare_image
+from image_processing import extract_page
+from mhs_layout_analisys import segment
+import utils
+
+# values tried for each parameter when no grid is given
+DEFAULT_GRID = {
+    'block_size': [31, 45, 61],     # black_and_white
+    'denoise': [False, True],       # remove_noise
+    'mhs': [False, True],           # segment before the OCR
+    'mhs_t': [0.01, 0.02],          # t of the splitting and the multi-layer filter in segment
+    'min_confidence': [30, 40, 50], # remove_low_confidence_paragraphs
+    'skew_scale': [1.0, 0.5],       # get_skew_angle
+}
+
+def get_configs(grid: dict) -> 'list[dict]':
+    '''Expand a grid into every combination of its values.
+
+    Combinations that only differ in mhs_t are kept once when mhs is off.
+
+    Args:
+        grid (dict): list of values of each parameter, see DEFAULT_GRID
+
+    Returns:
+        list[dict]: value of each parameter in each configuration
+    '''
+    grid = { **DEFAULT_GRID, **grid }
+    configs = []
+    for values in itertools.product(*grid.values()):
+        config = dict(zip(grid.keys(), values))
+        if not config['mhs']:
+            config['mhs_t'] = None
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+class StageCache:
+    '''Results of the pipeline stages of one page, by stage and parameters.
+
+    Each stage is computed once for all the configurations that share its
+    parameters and those of the stages before it, and its time is counted in
+    every one of them, so the seconds of a configuration are those of a run
+    from scratch.
+    '''
+    def __init__(self):
+        self.results = {}
+
+    def get(self, key: tuple, func) -> 'tuple[object, float]':
+        '''Get the result of a stage and the seconds it took, running func if it is not cached.'''
+        if key not in self.results:
+            start = time.perf_counter()
+            value = func()
+            self.results[key] = (value, time.perf_counter() - start)
+        return self.results[key]
+
+
+def run_config(image, cache: StageCache, config: dict) -> 'tuple[str, float]':
+    '''Run the pipeline of main.py on a page with a configuration.
+
+    Args:
+        image (cv2 image): page scan
+        cache (StageCache): stages already run on the page
+        config (dict): value of each parameter, see DEFAULT_GRID
+
+    Returns:
+        tuple(str, float): text of the page and the seconds the configuration takes on it
+    '''
+    from PIL import Image
+
+    seconds = 0
+    cropped, t = cache.get(('crop',), lambda: extract_page(image)[0])
+    seconds += t
+
+    mhs, skew_scale = config['mhs'], config['skew_scale']
+    key = ('prepare', config['block_size'], config['denoise'], mhs, skew_scale if mhs else None)
+    prepared, t = cache.get(key, lambda: prepare_image(cropped, rotate=mhs, denoise=config['denoise'], block_size=config['block_size'], skew_scale=skew_scale))
+    seconds += t
+
+    if mhs:
+        key += ('segment', config['mhs_t'])
+        segmented, t = cache.get(key, lambda: segment(prepared, t=config['mhs_t'])[0])
+        seconds += t
+        key += ('deskew', skew_scale)
+        final, t = cache.get(key, lambda: cv2.threshold(deskew(segmented, scale=skew_scale), 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1])
+    else:
+        key += ('deskew', skew_scale)
+        final, t = cache.get(key, lambda: deskew(prepared, passes=2, scale=skew_scale))
+    seconds += t
+
+    data, t = cache.get(key + ('ocr',), lambda: utils.get_ocr_data(Image.fromarray(final)))
+    seconds += t
+    (text, _, _), t = cache.get(key + ('text', config['min_confidence']), lambda: utils.get_text(data, min_confidence=config['min_confidence']))
+    seconds += t
+    return text, seconds
+
+
+def get_pareto_frontier(results: 'list[dict]') -> 'list[dict]':
+    '''Keep the configurations no other one beats in both accuracy and seconds.
+
+    Args:
+        results (list[dict]): mean "accuracy" and "seconds" of each configuration
+
+    Returns:
+        list[dict]: the configurations on the frontier, from the fastest to the slowest
+    '''
+    frontier = []
+    for r in sorted(results, key=lambda r: (r['seconds'], -r['accuracy'])):
+        if len(frontier) == 0 or r['accuracy'] > frontier[-1]['accuracy']:
+            frontier.append(r)
+    return frontier
+
+
+def sweep(pages: 'list[tuple[str, str]]', configs: 'list[dict]', verbose: bool = False) -> 'list[dict]':
+    '''Measure the accuracy and time of each configuration on pages with a known text.
+
+    Args:
+        pages (list[tuple[str, str]]): path of the scan and of the ground truth text of each page
+        configs (list[dict]): configurations to measure, see get_configs
+        verbose (bool): print the progress to console?
+
+    Returns:
+        list[dict]: each configuration with its mean "accuracy" and "seconds" per page
+    '''
+    totals = [{ 'accuracy': 0.0, 'seconds': 0.0 } for _ in configs]
+    for image_path, truth_path in pages:
+        if verbose: print(f'sweeping "{image_path}"')
+        image = utils.load_image(image_path)
+        with open(truth_path, encoding='utf-8') as f:
+            truth = f.read()
+        cache = StageCache() # the stages of a page are dropped before the next one
+        for config, total in zip(configs, totals):
+            text, seconds = run_config(image, cache, config)
+            total['accuracy'] += char_accuracy(truth, text)
+            total['seconds'] += seconds
+    return [{ **config, 'accuracy': t['accuracy'] / len(pages), 'seconds': t['seconds'] / len(pages) } for config, t in zip(configs, totals)]
+
+
+def get_ground_truth(folder: str) -> 'list[tuple[str, str]]':
+    '''Find the scans of a folder that have a text file with the same name.'''
+    scans = sorted(glob.glob(os.path.join(folder, '*.png')) + glob.glob(os.path.join(folder, '*.jpg')))
+    return [(s, os.path.splitext(s)[0] + '.txt') for s in scans if os.path.exists(os.path.splitext(s)[0] + '.txt')]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure the accuracy and speed of the pipeline parameters on pages with a known text.')
+    parser.add_argument('--grid', type=str, help='JSON file with a list of values for some of the parameters, e.g. {"block_size": [45], "mhs": [false]}. the others take the values of DEFAULT_GRID.')
+    parser.add_argument('--output', '-o', type=str, default='sweep.tsv', help='file to write the results to, with a column marking the pareto frontier. default=sweep.tsv')
+    parser.add_argument('--verbose', '-v', action='store_true', help='print the progress to console.')
+    parser.add_argument('ground_truth', help='folder with page scans and a .txt with the correct text of each one, e.g. page1.png and page1.txt')
+    args = parser.parse_args()
+
+    grid = {}
+    if args.grid:
+        with open(args.grid, encoding='utf-8') as f:
+            grid = json.load(f)
+    pages = get_ground_truth(args.ground_truth)
+    configs = get_configs(grid)
+    print(f'{len(configs)} configurations on {len(pages)} pages')
+
+    results = sweep(pages, configs, args.verbose)
+    frontier = get_pareto_frontier(results)
+    columns = list(configs[0].keys()) + ['accuracy', 'seconds', 'pareto']
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(columns) + '\n')
+        for r in sorted(results, key=lambda r: -r['accuracy']):
+            r['pareto'] = any(r is p for p in frontier)
+            f.write('\t'.join(str(r[c]) for c in columns) + '\n')
+
+    print('pareto frontier:')
+    for r in frontier:
+        print(f"{r['accuracy']:.4f}\t{r['seconds']:.2f}s\t" + ', '.join(f'{k}={v}' for k, v in r.items() if k not in ['accuracy', 'seconds', 'pareto']))
@@ -0,0 +1,190 @@
+import glob
+import os
+import re
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from array import array
+from unidecode import unidecode
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    edition TEXT NOT NULL,
+    page TEXT NOT NULL,
+    modified REAL,
+    UNIQUE (edition, page)
+);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL,
+    page_id INTEGER NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (term_id, page_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_page ON postings (page_id);
+'''
+
+def tokenize(text: str) -> 'list[str]':
+    '''Split a text into words, without accents and in lowercase, as evaluate_quality compares texts.'''
+    return re.findall(r'[a-z0-9]+', unidecode(text).lower())
+
+
+def to_blob(positions: array) -> bytes:
+    '''Store word positions as little-endian 32 bit integers, so the index can be moved between hosts.'''
+    if sys.byteorder == 'big':
+        positions = array('I', positions)
+        positions.byteswap()
+    return positions.tobytes()
+
+
+def from_blob(blob: bytes) -> array:
+    '''Read the word positions stored by to_blob.'''
+    positions = array('I', blob)
+    if sys.byteorder == 'big':
+        positions.byteswap()
+    return positions
+
+
+class TextIndex:
+    '''Inverted index of the OCR output in a SQLite file.
+
+    Stores, for each word, the pages it is in and its positions in each page,
+    so keyword and phrase queries read only the postings of the query words.
+    Indexing a page again replaces only the postings of that page.
+
+    Args:
+        path (str): path to the SQLite file, created if it does not exist
+    '''
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def get_term_ids(self, terms: 'list[str]', create: bool = False) -> dict:
+        '''Get the ids of words, adding the missing ones to the index if create.'''
+        if create:
+            self.connection.executemany('INSERT OR IGNORE INTO terms (term) VALUES (?)', [(t,) for t in terms])
+        ids = {}
+        for i in range(0, len(terms), 500): # stay below the SQLite limit of query parameters
+            chunk = terms[i:i+500]
+            ids.update(self.connection.execute(f'SELECT term, id FROM terms WHERE term IN ({",".join("?" * len(chunk))})', chunk).fetchall())
+        return ids
+
+    def add_page(self, edition: str, page: str, text: str, modified: float = None):
+        '''Index the text of a page, replacing its previous postings.
+
+        Args:
+            edition (str): edition name
+            page (str): page name
+            text (str): text of the page
+            modified (float): modification time of the text file, used to skip unchanged pages. default=None
+        '''
+        positions = {}
+        for i, term in enumerate(tokenize(text)):
+            positions.setdefault(term, array('I')).append(i)
+        with self.connection:
+            self.connection.execute('INSERT INTO pages (edition, page, modified) VALUES (?, ?, ?) ON CONFLICT (edition, page) DO UPDATE SET modified = excluded.modified',
+                                    (edition, page, modified))
+            page_id = self.connection.execute('SELECT id FROM pages WHERE edition = ? AND page = ?', (edition, page)).fetchone()[0]
+            self.connection.execute('DELETE FROM postings WHERE page_id = ?', (page_id,))
+            term_ids = self.get_term_ids(list(positions), create=True)
+            self.connection.executemany('INSERT INTO postings (term_id, page_id, positions) VALUES (?, ?, ?)',
+                                        [(term_ids[term], page_id, to_blob(p)) for term, p in positions.items()])
+
+    def remove_page(self, edition: str, page: str):
+        '''Remove a page and its postings from the index.'''
+        with self.connection:
+            self.connection.execute('DELETE FROM postings WHERE page_id IN (SELECT id FROM pages WHERE edition = ? AND page = ?)', (edition, page))
+            self.connection.execute('DELETE FROM pages WHERE edition = ? AND page = ?', (edition, page))
+
+    def get_postings(self, term: str) -> dict:
+        '''Get the positions of a word in each page it is in, by page id.'''
+        rows = self.connection.execute('SELECT page_id, positions FROM postings JOIN terms ON terms.id = term_id WHERE term = ?', (term,))
+        return { page_id: from_blob(positions) for page_id, positions in rows }
+
+    def search(self, query: str, phrase: bool = False) -> 'list[tuple[str, str, int]]':
+        '''Find the pages with every word of a query.
+
+        Args:
+            query (str): words to look for, normalised as the indexed text
+            phrase (bool): only match the words in sequence. default=False
+
+        Returns:
+            list[tuple[str, str, int]]: edition, page and number of matches,
+            the sum of the occurrences of each word, or of the phrase if phrase,
+            from the most matches to the least
+        '''
+        terms = tokenize(query)
+        if len(terms) == 0:
+            return []
+        postings = { term: self.get_postings(term) for term in dict.fromkeys(terms) }
+        pages = set.intersection(*(set(p) for p in postings.values()))
+        if phrase:
+            matches = {}
+            for page_id in pages:
+                rest = [(i, set(postings[term][page_id])) for i, term in enumerate(terms) if i > 0]
+                count = sum(all(p + i in positions for i, positions in rest) for p in postings[terms[0]][page_id])
+                if count > 0:
+                    matches[page_id] = count
+        else:
+            matches = { page_id: sum(len(p[page_id]) for p in postings.values()) for page_id in pages }
+
+        names = {}
+        for page_id in matches:
+            names[page_id] = self.connection.execute('SELECT edition, page FROM pages WHERE id = ?', (page_id,)).fetchone()
+        return sorted(((*names[i], count) for i, count in matches.items()), key=lambda m: (-m[2], m[0], m[1]))
+
+    def update(self, output_folder: str = './output', filename: str = 'proc.txt', verbose: bool = False) -> int:
+        '''Index the text files of an output tree that changed since they were last indexed.
+
+        Args:
+            output_folder (str): folder with an <edition>/<page>/ folder for each page. default='./output'
+            filename (str): name of the text file of each page. default='proc.txt'
+            verbose (bool): print each page indexed? default=False
+
+        Returns:
+            int: number of pages indexed
+        '''
+        known = { (e, p): m for e, p, m in self.connection.execute('SELECT edition, page, modified FROM pages') }
+        count = 0
+        for path in glob.glob(os.path.join(output_folder, '*', '*', filename)):
+            folder = os.path.dirname(path)
+            key = (os.path.basename(os.path.dirname(folder)), os.path.basename(folder))
+            modified = os.path.getmtime(path)
+            if known.get(key) == modified:
+                continue
+            with open(path, encoding='utf-8') as f:
+                self.add_page(*key, f.read(), modified)
+            count += 1
+            if verbose: print(f'indexed page "{key[1]}" from "{key[0]}"')
+        return count
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build and query the full text index of the OCR output.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='index the pages that changed since the last build.')
+    build.add_argument('--output', '-o', type=str, default='./output', help='folder with the OCR output. default=./output')
+    build.add_argument('--filename', type=str, default='proc.txt', help='text file of each page to index. default=proc.txt')
+    build.add_argument('--verbose', '-v', action='store_true', help='print each page indexed.')
+    build.add_argument('index', help='path to the index file')
+    query = subparsers.add_parser('query', help='list the pages with every word of a query.')
+    query.add_argument('--phrase', action='store_true', help='only match the words in sequence.')
+    query.add_argument('--limit', type=int, default=50, help='maximum number of pages to list. default=50')
+    query.add_argument('index', help='path to the index file')
+    query.add_argument('words', nargs='+', help='words to look for')
+    args = parser.parse_args()
+
+    index = TextIndex(args.index)
+    if args.command == 'build':
+        print(f'{index.update(args.output, args.filename, args.verbose)} pages indexed')
+    else:
+        for edition, page, count in index.search(' '.join(args.words), args.phrase)[:args.limit]:
+            print(f'{edition}\t{page}\t{count}')
+    index.close()
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+def get_tiles(shape: 'tuple[int, int]', tile_size: int) -> 'list[tuple[int, int, int, int]]':
+    '''Split an image into a grid of tiles.
+
+    Args:
+        shape (tuple[int, int]): shape of the image (h, w)
+        tile_size (int): width and height of the tiles
+
+    Returns:
+        list[tuple[int, int, int, int]]: coordinates (x1, x2, y1, y2) of each tile
+    '''
+    h, w = shape[:2]
+    return [(x, min(x + tile_size, w), y, min(y + tile_size, h)) for y in range(0, h, tile_size) for x in range(0, w, tile_size)]
+
+
+def process_tiled(image, func, halo: int, tile_size: int = 1024, workers: int = None):
+    '''Apply a local operation to an image tile by tile, using a thread pool.
+
+    Each tile is read with a margin of halo pixels on every side, so a
+    filter with a radius of at most halo sees the same neighbourhood as it
+    would on the full image and the stitched result is identical to
+    func(image). Tiles touching the image border use the real border, so the
+    border handling of OpenCV is preserved too. OpenCV releases the GIL, so the
+    tiles run in parallel, and only tile sized temporaries are allocated.
+
+    Args:
+        image (cv2 image): image to process
+        func (callable): operation that maps an image to an image of the same height and width
+        halo (int): how far, in pixels, func looks around each pixel
+        tile_size (int): width and height of the tiles, without the halo. default=1024
+        workers (int): number of threads, defaults to the number of CPUs
+
+    Returns:
+        cv2 image: the result of func on the whole image
+    '''
+    h, w = image.shape[:2]
+    tiles = get_tiles(image.shape, tile_size)
+    if len(tiles) == 1:
+        return func(image)
+
+    def run(tile):
+        x1, x2, y1, y2 = tile
+        hx1, hy1 = max(x1 - halo, 0), max(y1 - halo, 0)
+        hx2, hy2 = min(x2 + halo, w), min(y2 + halo, h)
+        result = func(image[hy1:hy2, hx1:hx2])
+        return result[y1-hy1:y2-hy1, x1-hx1:x2-hx1]
+
+    # the first tile tells the type and the number of channels of the output
+    first = run(tiles[0])
+    output = np.empty((h, w) + first.shape[2:], dtype=first.dtype)
+    x1, x2, y1, y2 = tiles[0]
+    output[y1:y2, x1:x2] = first
+
+    def store(tile):
+        x1, x2, y1, y2 = tile
+        output[y1:y2, x1:x2] = run(tile)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(store, tiles[1:]))
+
+    return output
@@ -0,0 +1,92 @@
+import os
+import cv2
+import numpy as np
+
+BLANK_INK = 0.003 # pages with less ink than this fraction of their pixels are blank
+MIN_TEXT_CCS = 50 # pages with fewer text-like CCs than this have nothing to read
+MIN_REGION_TEXT_CCS = 3 # same, for MHS regions
+FAST_TEXT_RATIO = 0.85 # pages with more of their ink in text-like CCs than this have nothing for MHS to remove
+
+def get_ink_stats(inv) -> dict:
+    '''Measure the ink of a binary image and how much of it looks like text.
+
+    Uses the size, density and aspect ratio tests of heuristic_filter on the
+    connected component statistics OpenCV returns, without the costly count of
+    inner CCs, and takes as text only the CCs at most 4 times taller than the
+    median, so rules, pictures and large titles are left out.
+
+    Args:
+        inv (cv2 image): inverse binary image, ink > 0
+
+    Returns:
+        dict: fraction of "ink" pixels, number of "ccs", number of "text_ccs",
+        fraction of the ink in text CCs ("text_ratio") and "median_height" of the text CCs
+    '''
+    n, _, cc, _ = cv2.connectedComponentsWithStats(inv, connectivity=8, ltype=cv2.CV_32S)
+    cc = cc[1:]
+    w, h, area = cc[:, cv2.CC_STAT_WIDTH], cc[:, cv2.CC_STAT_HEIGHT], cc[:, cv2.CC_STAT_AREA]
+    is_text = (area >= 20) & (np.minimum(w, h) >= 0.1 * np.maximum(w, h)) & (area >= 0.06 * w * h)
+    median_height = float(np.median(h[is_text])) if is_text.any() else 0.0
+    is_text &= h <= 4 * median_height
+    ink = int(area.sum())
+    return {
+        'ink': ink / inv.size,
+        'ccs': n - 1,
+        'text_ccs': int(is_text.sum()),
+        'text_ratio': float(area[is_text].sum() / ink) if ink > 0 else 0.0,
+        'median_height': median_height,
+    }
+
+
+def triage_page(img_bw) -> 'tuple[str, str, dict]':
+    '''Choose how much work a page needs.
+
+    Args:
+        img_bw (cv2 image): binarized page, black text on white as returned by prepare_image
+
+    Returns:
+        tuple[str, str, dict]: "skip", "fast" (no MHS) or "full" (MHS), the
+        reason of the choice and the statistics it is based on, see get_ink_stats
+    '''
+    stats = get_ink_stats(np.uint8(img_bw < 128))
+    if stats['ink'] < BLANK_INK:
+        return 'skip', 'blank', stats
+    if stats['text_ccs'] < MIN_TEXT_CCS:
+        return 'skip', 'no text, e.g. a photo', stats
+    if stats['text_ratio'] >= FAST_TEXT_RATIO:
+        return 'fast', 'text only', stats
+    return 'full', 'text and non-text', stats
+
+
+def triage_region(region) -> 'tuple[str, str, dict]':
+    '''Choose whether an MHS region is worth reading.
+
+    Args:
+        region (cv2 image): inverse binary region, as returned by segment
+
+    Returns:
+        tuple[str, str, dict]: "skip" or "full", the reason of the choice and the statistics it is based on
+    '''
+    stats = get_ink_stats(np.uint8(region > 0))
+    if stats['text_ccs'] < MIN_REGION_TEXT_CCS:
+        return 'skip', 'no text', stats
+    return 'full', 'text', stats
+
+
+def write_triage_log(path: str, edition: str, page: str, region: str, decision: str, reason: str, stats: dict):
+    '''Append a routing decision to a tab separated log.
+
+    Args:
+        path (str): path of the log file, created with a header if it does not exist
+        edition (str): edition name
+        page (str): page name
+        region (str): "page", or the index of the MHS region
+        decision (str): skip, fast or full
+        reason (str): why the decision was made
+        stats (dict): statistics the decision is based on, see get_ink_stats
+    '''
+    is_new = not os.path.exists(path)
+    with open(path, 'a', encoding='utf-8') as f:
+        if is_new:
+            f.write('edition\tpage\tregion\tdecision\treason\tink\tccs\ttext_ccs\ttext_ratio\tmedian_height\n')
+        f.write(f"{edition}\t{page}\t{region}\t{decision}\t{reason}\t{stats['ink']:.4f}\t{stats['ccs']}\t{stats['text_ccs']}\t{stats['text_ratio']:.3f}\t{stats['median_height']:.1f}\n")
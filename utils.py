@@ -1,5 +1,6 @@
+import threading
 import cv2
-from matplotlib import pyplot as plt
+import numpy as np
 
 def display(im_path: str):
     '''Display the image using matplotlib.
@@ -12,6 +13,8 @@ def display(im_path: str):
     Remarks:
         https://stackoverflow.com/questions/28816046/
     '''
+    from matplotlib import pyplot as plt
+
     dpi = 80
     im_data = plt.imread(im_path)
 
@@ -33,6 +36,19 @@ def display(im_path: str):
     plt.show()
 
 
+# page_io.AsyncWriter used by conditional_save and write_text, None writes synchronously
+WRITER = None
+
+def set_writer(writer):
+    '''Send the writes of conditional_save and write_text to a background writer.
+
+    Args:
+        writer (page_io.AsyncWriter): the writer to use, None to write synchronously again
+    '''
+    global WRITER
+    WRITER = writer
+
+
 def conditional_save(image, save_to: str = None):
     '''Save an image to disk.
 
@@ -41,7 +57,97 @@ def conditional_save(image, save_to: str = None):
         save_to (str): path to save the image to. does not save if equals None. default=None
     '''
     if save_to:
-        cv2.imwrite(save_to, image)
+        if WRITER is not None:
+            WRITER.save_image(save_to, image)
+        else:
+            cv2.imwrite(save_to, image)
+
+
+def write_text(text: str, save_to: str):
+    '''Write a text to disk as utf-8.
+
+    Args:
+        text (str): text to write
+        save_to (str): path of the text file
+    '''
+    if WRITER is not None:
+        WRITER.write_text(save_to, text)
+    else:
+        with open(save_to, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+def get_intermediate_path(save_to: str, fmt: str = 'png') -> str:
+    '''Get the path of an intermediate image in the chosen format.
+
+    Args:
+        save_to (str): path of the image, with any extension
+        fmt (str): 'png' or 'npy'. default='png'
+    
+    Returns:
+        str: the path with the extension of the format
+    '''
+    return os.path.splitext(save_to)[0] + '.' + fmt
+
+
+def write_array(array, save_to: str):
+    '''Write an array with np.save, replacing the file only once it is complete.
+
+    A run that crashes while writing leaves a temporary file behind instead of
+    a truncated array that load_intermediate would map into memory.
+
+    Args:
+        array (np.ndarray): array to write
+        save_to (str): path of the .npy file
+    '''
+    temp_path = f'{save_to}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(temp_path, save_to)
+
+
+def save_intermediate(image, save_to: str = None, fmt: str = 'png') -> str:
+    '''Save an image that later stages or reruns read back.
+
+    The 'npy' format is the raw array with a small header describing its
+    shape and type, which load_intermediate maps into memory without decoding
+    or copying. 'png' is compressed and can be opened by any viewer.
+
+    Args:
+        image (cv2 image): image to save
+        save_to (str): path to save the image to, its extension is replaced by the format. does not save if equals None. default=None
+        fmt (str): 'png' or 'npy'. default='png'
+    
+    Returns:
+        str: path of the saved file
+    '''
+    if not save_to:
+        return None
+    save_to = get_intermediate_path(save_to, fmt)
+    if fmt == 'png':
+        conditional_save(image, save_to)
+    elif WRITER is not None:
+        WRITER.save_array(save_to, image)
+    else:
+        write_array(image, save_to)
+    return save_to
+
+
+def load_intermediate(path: str):
+    '''Load an image saved by save_intermediate.
+
+    Args:
+        path (str): path of the .npy or .png file
+    
+    Returns:
+        cv2 image: the image, read-only and memory-mapped if it is a .npy file
+    '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f'failed to read image at "{path}, does it exist?"')
+    return image
 
 
 def get_conditional_path(filename: str, folder: str = None) -> str:
@@ -62,7 +168,6 @@ def get_name(file_path, ext_size=4):
     last = file_path.replace('\\', '/').split('/')[-1]
     return last[:-ext_size] if ext_size > 0 else last
 
-import pdf2image
 import glob
 import os
 from unidecode import unidecode
@@ -84,6 +189,8 @@ def convert_pdfs(input_files: 'list[str]' = [], output_folder: str = './tmp', ve
 
     '''
 
+    import pdf2image
+
     for file_path in input_files:
         name = get_name(file_path)
         if verbose: print('processing file:', name)
@@ -104,32 +211,63 @@ def load_image(path: str):
         raise ValueError(f'failed to read image at "{path}, does it exist?"')
     return image
 
+def get_image_size(path: str) -> 'tuple[int, int]':
+    '''Read the size of an image without decoding it.
+
+    Args:
+        path (str): path of the image
+    
+    Returns:
+        tuple[int, int]: width and height of the image
+    '''
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return img.size
+
 # Processing
 
-from PIL import Image
-import pytesseract
+import csv
+import io
 
-def run_ocr(image_path: str, output_path: str = None, temp_path: str = None, treat_confidence: bool = True, remove_spaces: bool = True, remove_hyphenation: bool = True, verbose: bool = False) -> 'tuple[str, float]':
-    '''Detect portuguese text from an image using pytesseract.
+TESSERACT_CMD = 'tesseract' # command run by race_ocr
+# columns of the tesseract TSV output, as in pytesseract.image_to_data
+TSV_COLUMNS = ['level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height', 'conf', 'text']
 
-    Load an image from a path and run it through pytesseract to detect text.
+def get_ocr_data(img, engine=None) -> 'pd.DataFrame':
+    '''Run tesseract on an image and get the detected words and their boxes.
 
     Args:
-        image_path (str): path of input image
-        output_path (str): path to write text output to, does not save if equals None. default=None
-        temp_folder (str): folder to save the image of the tesseract detected blocks, does not save if equals None. default=None
+        img (PIL image): image to read
+        engine (tesserocr.PyTessBaseAPI): tesseract instance that is kept loaded between calls, runs the tesseract command through pytesseract if equals None. default=None
+
+    Returns:
+        pd.DataFrame: one row per page, block, paragraph, line and word, with the columns in TSV_COLUMNS
+    '''
+    if engine is None:
+        import pytesseract
+        return pytesseract.image_to_data(img, lang='por', output_type=pytesseract.Output.DATAFRAME)
+    import pandas as pd
+
+    engine.SetImage(img)
+    return pd.read_csv(io.StringIO(engine.GetTSVText(0)), sep='\t', names=TSV_COLUMNS, quoting=csv.QUOTE_NONE)
+
+
+def get_text(data: 'pd.DataFrame', treat_confidence: bool = True, remove_spaces: bool = True, remove_hyphenation: bool = True, min_confidence: float = 40, verbose: bool = False) -> 'tuple[str, float, pd.DataFrame]':
+    '''Join the words detected by tesseract into the text of a page.
+
+    Args:
+        data (pd.DataFrame): tesseract output, see get_ocr_data. It is not modified
+        treat_confidence (bool): flag to remove the paragraphs with low confidence. default=True
         remove_spaces (bool): flag to remove extra spaces in post-processing. default=True
         remove_hyphenation (bool): flag to remove hyphenation, joining words in post-processing. default=True
+        min_confidence (float): minimum mean confidence of the paragraphs kept if treat_confidence. default=40
         verbose (bool): write extra information to console?
 
     Returns:
-        tuple(str, float): text detected and mean confidence score
+        tuple(str, float, pd.DataFrame): text, mean confidence score and the rows that were kept
     '''
-    img = Image.open(image_path)
-    if verbose:
-        print(f'read image from "{image_path}"')
-    
-    data = pytesseract.image_to_data(img, lang='por', output_type=pytesseract.Output.DATAFRAME)
+    data = data.copy()
     conf = data[data['conf'] > -1]['conf'].mean()
     data['text'] = data['text'].fillna('')
     data['text'] = data['text'].astype(str)
@@ -140,21 +278,15 @@ def run_ocr(image_path: str, output_path: str = None, temp_path: str = None, tre
                                    data['par_num'].astype(str).str.rjust(3,'0')).astype(int)
     if treat_confidence:
         before = data['page_block_par_num'].nunique()
-        data = remove_low_confidence_paragraphs(data)
+        data = remove_low_confidence_paragraphs(data, min_confidence)
         after = data['page_block_par_num'].nunique()
         if verbose:
             print(f'confidence based paragraph removal went from {before} to {after} paragraphs')
     
     lines = data.groupby('page_block_par_num')['text'].sum().str.strip() + '\n'
-    result = lines.sum().strip()
+    result = lines.str.cat().strip() # empty when every paragraph was removed
     if verbose:
         print(f'detected {len(result)} characters in image')
-    
-    blocks = data[data['level'] == 3]
-    cvImg = cv2.imread(image_path)
-    for _, block in blocks.iterrows():
-        cv2.rectangle(cvImg, (block['left'], block['top']), (block['left'] + block['width'], block['top'] + block['height']), (0, 255, 0), 2)
-    conditional_save(cvImg, temp_path)
 
     if remove_spaces:
         result = remove_extra_spaces(result)
@@ -164,43 +296,200 @@ def run_ocr(image_path: str, output_path: str = None, temp_path: str = None, tre
         result = treat_hyphenation(result)
         if verbose: print(f'after hyphenation removal, got {len(result)} characters')
 
+    return result, conf, data
+
+def run_ocr(image_path, output_path: str = None, temp_path: str = None, treat_confidence: bool = True, remove_spaces: bool = True, remove_hyphenation: bool = True, verbose: bool = False, engine=None, return_data: bool = False, min_confidence: float = 40) -> 'tuple[str, float]':
+    '''Detect portuguese text from an image using pytesseract.
+
+    Load an image from a path and run it through pytesseract to detect text.
+
+    Args:
+        image_path (str or cv2 image): path of input image, or the image itself
+        output_path (str): path to write text output to, does not save if equals None. default=None
+        temp_folder (str): folder to save the image of the tesseract detected blocks, does not save if equals None. default=None
+        remove_spaces (bool): flag to remove extra spaces in post-processing. default=True
+        remove_hyphenation (bool): flag to remove hyphenation, joining words in post-processing. default=True
+        verbose (bool): write extra information to console?
+        engine (tesserocr.PyTessBaseAPI): loaded tesseract instance to use instead of running the tesseract command, see get_ocr_data. default=None
+        return_data (bool): also return the words that were kept, with their boxes and confidences. default=False
+        min_confidence (float): minimum mean confidence of the paragraphs kept if treat_confidence. default=40
+
+    Returns:
+        tuple(str, float): text detected and mean confidence score, followed by
+        the word rows of the tesseract output (pd.DataFrame) if return_data
+    '''
+    from PIL import Image
+
+    if isinstance(image_path, str):
+        img = Image.open(image_path)
+        if verbose:
+            print(f'read image from "{image_path}"')
+    else:
+        cvImg = image_path
+        img = Image.fromarray(cvImg if cvImg.ndim == 2 else cv2.cvtColor(cvImg, cv2.COLOR_BGR2RGB))
+    
+    data = get_ocr_data(img, engine)
+    result, conf, data = get_text(data, treat_confidence, remove_spaces, remove_hyphenation, min_confidence, verbose)
+    
+    if temp_path:
+        blocks = data[data['level'] == 3]
+        cvImg = cv2.imread(image_path) if isinstance(image_path, str) else cv2.cvtColor(cvImg, cv2.COLOR_GRAY2BGR) if cvImg.ndim == 2 else cvImg.copy()
+        for _, block in blocks.iterrows():
+            cv2.rectangle(cvImg, (block['left'], block['top']), (block['left'] + block['width'], block['top'] + block['height']), (0, 255, 0), 2)
+        conditional_save(cvImg, temp_path)
+
     if output_path:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            if verbose: print(f'writing result to "{output_path}"')
-            f.write(result)
+        if verbose: print(f'writing result to "{output_path}"')
+        write_text(result, output_path)
     
+    if return_data:
+        return result, conf, data[data['level'] == 5]
     return result, conf
 
 def run_ocr_on_columns(columns_path: 'list[str]', temp_folder: str, output_path: str, verbose: bool = False) -> 'tuple[str, float]':
     '''Detect text from multiple images and append them together
 
     Args:
-        columns_path (list[str]): list of paths to the images to process
+        columns_path (list[str]): list of paths to the images (or the cv2 images) to process
         temp_folder (str): path to a directory to write the text files for each image
-        output_path (str): path to a text file to write the final output
+        output_path (str): path to a text file to write the final output, does not save if equals None
 
     Returns:
         tuple(str, float): All of the detected texts and mean confidence score
     '''
     avg_conf = 0
+    result = []
     for i in range(len(columns_path)):
         out = os.path.join(temp_folder, f'{i}.txt')
-        _, conf = run_ocr(columns_path[i], out, verbose=verbose)
+        text, conf = run_ocr(columns_path[i], out, verbose=verbose)
+        result.append(text)
         avg_conf += conf
     avg_conf /= len(columns_path)
 
-    result = []
-    for i in range(len(columns_path)):
-        text_file = os.path.join(temp_folder, f'{i}.txt')
-        with open(text_file, encoding='utf-8') as f:
-            result.append(f.read())
-
     result = '\n\n'.join(result)
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(result)
+    if output_path:
+        write_text(result, output_path)
     
     return result, avg_conf
 
+class TesseractProcess:
+    '''The tesseract command reading an image in a child process that can be killed.
+
+    Args:
+        image (str or cv2 image): path of the image, or the image itself, which is written to a temporary file
+    '''
+    def __init__(self, image):
+        import subprocess
+        import tempfile
+
+        self.temp_path = None
+        try:
+            if not isinstance(image, str):
+                fd, self.temp_path = tempfile.mkstemp(suffix='.png')
+                os.close(fd)
+                cv2.imwrite(self.temp_path, image)
+            self.process = subprocess.Popen([TESSERACT_CMD, self.temp_path or image, 'stdout', '-l', 'por', 'tsv'],
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=os.name == 'posix')
+        except Exception:
+            self.remove_temp()
+            raise
+
+    def result(self) -> 'pd.DataFrame':
+        '''Wait for tesseract and get its output, as get_ocr_data.
+
+        Raises:
+            RuntimeError: if tesseract failed or was killed
+        '''
+        import pandas as pd
+
+        try:
+            out, err = self.process.communicate()
+        finally:
+            self.remove_temp()
+        if self.process.returncode != 0:
+            raise RuntimeError(f'tesseract exited with {self.process.returncode}: {err.decode(errors="replace").strip()}')
+        return pd.read_csv(io.BytesIO(out), sep='\t', quoting=csv.QUOTE_NONE)
+
+    def kill(self):
+        '''Stop tesseract and wait for it to exit.'''
+        if self.process.poll() is None:
+            if os.name == 'posix':
+                import signal
+                try:
+                    os.killpg(self.process.pid, signal.SIGKILL) # also the children of a tesseract wrapper script
+                except ProcessLookupError:
+                    pass
+            else:
+                self.process.kill()
+        self.process.wait()
+        self.remove_temp()
+
+    def remove_temp(self):
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def race_ocr(variants: dict, output_path: str = None, min_confidence: float = None, verbose: bool = False) -> 'tuple[str, str, float]':
+    '''Run the OCR on several versions of a page at the same time and keep the most confident.
+
+    Each variant runs in its own tesseract process. As soon as one reaches
+    min_confidence, the processes still running are killed, and the function
+    waits for them to exit before returning. A variant that fails, to start
+    or to read, is dropped from the race.
+
+    Args:
+        variants (dict): name of each variant and its image, or the path to it, in order of preference
+        output_path (str): path to write the text of the best variant to, does not save if equals None. default=None
+        min_confidence (float): mean confidence that is good enough to stop, waits for every variant if equals None. default=None
+        verbose (bool): write extra information to console?
+
+    Returns:
+        tuple(str, str, float): name of the best variant, its text and mean
+        confidence, NaN if no variant found any word. None as the name if every variant failed
+    '''
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    processes = {}
+    pending = set()
+    best, best_score = (None, '', float('nan')), None
+    try:
+        for name, image in variants.items():
+            try:
+                processes[name] = TesseractProcess(image)
+            except Exception as e:
+                print(f'variant "{name}" failed to start: {e!r}')
+        with ThreadPoolExecutor(max_workers=max(len(processes), 1)) as executor:
+            futures = { executor.submit(p.result): name for name, p in processes.items() }
+            pending = set(futures)
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in sorted(done, key=lambda f: list(variants).index(futures[f])):
+                        try:
+                            text, conf, _ = get_text(future.result())
+                        except Exception as e:
+                            print(f'variant "{futures[future]}" failed: {e!r}')
+                            continue
+                        score = -1 if conf != conf else conf # a variant without words has NaN confidence
+                        if verbose:
+                            print(f'variant "{futures[future]}" has mean confidence {conf:.1f}')
+                        if best_score is None or score > best_score:
+                            best, best_score = (futures[future], text, conf), score
+                    if min_confidence is not None and best_score is not None and best_score >= min_confidence:
+                        break
+            finally:
+                for future in pending:
+                    processes[futures[future]].kill() # before the executor waits for them
+    finally:
+        for process in processes.values():
+            process.kill() # waits for the ones already done, in case the loop failed
+
+    if verbose:
+        print(f'kept variant "{best[0]}", {len(pending)} variants stopped early')
+    if output_path and best[0] is not None:
+        write_text(best[1], output_path)
+    return best
+
 # Post processing
 
 import re
@@ -229,10 +518,9 @@ def treat_hyphenation(text: str) -> str:
     text = re.sub('- *\n *', '', text)
     return text
 
-import pandas as pd
-def remove_low_confidence_paragraphs(data: pd.DataFrame) -> pd.DataFrame:
+def remove_low_confidence_paragraphs(data: 'pd.DataFrame', min_confidence: float = 40) -> 'pd.DataFrame':
     only_words = data[data['level'] == 5]
-    keep = only_words.groupby('page_block_par_num')['conf'].mean() > 40
+    keep = only_words.groupby('page_block_par_num')['conf'].mean() > min_confidence
     keep = keep.reset_index()
     keep = keep.loc[keep['conf'], 'page_block_par_num']
     